@@ -2,7 +2,7 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from flask import Flask, send_from_directory
+from flask import Flask, jsonify, send_from_directory
 from flask_sqlalchemy import SQLAlchemy
 import logging
 import os
@@ -41,6 +41,30 @@ def sumup_html():
     return html.sumup()
 
 
+@app.route('/sumups.json', methods=['POST'])
+def sumups_json():
+    from crashstop import html
+    return html.sumups()
+
+
+@app.route('/api/signatures')
+def api_signatures():
+    from crashstop import api
+    return api.sgns()
+
+
+@app.route('/api/bug/<int:bugid>')
+def api_bug(bugid):
+    from crashstop import api
+    return api.bug(bugid)
+
+
+@app.route('/cache_metrics.json')
+def cache_metrics():
+    from crashstop import cache
+    return jsonify(cache.get_metrics())
+
+
 @app.route('/clouseau.ico')
 @app.route('/favicon.ico')
 def favicon():
@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from flask import request, Response
+import json
+from . import utils, models, cache
+
+
+API_FORMAT = '1'
+
+
+def get_etag():
+    """The data only change with an update so the etag is made from the
+       date of the last update (which is in memcached)"""
+    last_date = cache.get_last_date()
+    return cache.get_hash('\n'.join(['api', API_FORMAT, str(last_date)]))
+
+
+def get_date(date):
+    return date.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def get_versions(versions):
+    """Get the buildids and the corresponding versions as two lists"""
+    dates = sorted(versions.keys())
+    return ([utils.get_buildid(d) for d in dates],
+            [versions[d] for d in dates])
+
+
+def get_signatures_json(data):
+    buildids, versions = get_versions(data['versions'])
+    sgns = {}
+    for sgn, info in data['signatures'].items():
+        sgns[sgn] = {'bugid': info['bugid'],
+                     'pushdate': get_date(info['pushdate']),
+                     'raw': info['raw'],
+                     'installs': info['installs'],
+                     'success': info['success']}
+
+    return {'buildids': buildids,
+            'versions': versions,
+            'signatures': sgns}
+
+
+def get_bug_json(data):
+    res = {}
+    for prod, i in data['data'].items():
+        res[prod] = res_prod = {}
+        for chan, j in i.items():
+            buildids, versions = get_versions(data['versions'][(prod, chan)])
+            sgns = {}
+            for sgn, info in j.items():
+                sgns[sgn] = {'pushdate': get_date(info['pushdate']),
+                             'raw': info['raw'],
+                             'installs': info['installs'],
+                             'success': info['success']}
+            res_prod[chan] = {'buildids': buildids,
+                              'versions': versions,
+                              'signatures': sgns}
+    return res
+
+
+def conditional(f, *args):
+    """Answer with a 304 when the client already has the data, else call
+       f to get the data and send them as compact json"""
+    etag = get_etag()
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        data = json.dumps(f(*args), separators=(',', ':'))
+        response = Response(data, mimetype='application/json')
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def sgns():
+    product = request.args.get('product', '')
+    product = utils.get_correct_product(product)
+    channel = request.args.get('channel', '')
+    channel = utils.get_correct_channel(channel)
+    filt = request.args.get('filter', 'all')
+    filt = utils.get_correct_filter(filt)
+
+    def get_data():
+        data = models.Signatures.get_bypc(product, channel, filt)
+        data = get_signatures_json(data)
+        data.update({'product': product,
+                     'channel': channel,
+                     'filter': filt})
+        return data
+
+    return conditional(get_data)
+
+
+def bug(bugid):
+    def get_data():
+        data = models.Signatures.get_bybugid(bugid)
+        return {'bugid': bugid,
+                'data': get_bug_json(data)}
+
+    return conditional(get_data)
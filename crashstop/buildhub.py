@@ -3,6 +3,7 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import json
+import random
 import requests
 import time
 from . import config, datacollector as dc, utils
@@ -18,23 +19,73 @@ SOCORRO_PRODUCTS = ['Firefox', 'FennecAndroid']
 RPRODS = {'firefox': 'Firefox',
           'devedition': 'Firefox',
           'fennec': 'FennecAndroid'}
+TIMEOUT = 60
+MAX_SLEEP = 60
+# the total time we can wait between the attempts
+MAX_RETRY_TIME = 600
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+__SESSION = None
+
+
+def get_session():
+    """Get the session used to query Buildhub (the connection is kept alive)"""
+    global __SESSION
+    if __SESSION is None:
+        __SESSION = requests.Session()
+    return __SESSION
+
+
+def get_delay(headers, sleep, attempt):
+    """Get the time to wait before the next attempt.
+
+       Args:
+           headers (dict): the response headers
+           sleep (float): the base time to wait
+           attempt (int): the number of the failed attempt (from 0)
+       Returns:
+           float: the Backoff value sent by the server if any, else an
+                  exponential backoff with jitter
+    """
+    try:
+        return float(headers['Backoff'])
+    except (KeyError, TypeError, ValueError):
+        pass
+
+    delay = min(sleep * 2 ** attempt, MAX_SLEEP)
+    return random.uniform(delay / 2., delay)
 
 
 def make_request(params, sleep, retry, callback):
     """Query Buildhub"""
     params = json.dumps(params)
-
-    for _ in range(retry):
-        r = requests.post(URL, data=params)
-        if 'Backoff' in r.headers:
-            time.sleep(sleep)
+    session = get_session()
+    deadline = time.time() + MAX_RETRY_TIME
+
+    for attempt in range(retry):
+        try:
+            r = session.post(URL, data=params, timeout=TIMEOUT)
+        except requests.exceptions.RequestException as e:
+            logger.warning('Buildhub query failed: {}'.format(e))
+            delay = get_delay({}, sleep, attempt)
         else:
-            try:
-                return callback(r.json())
-            except BaseException as e:
-                logger.error('Buildhub query failed with parameters: {}.'.format(params))
-                logger.error(e, exc_info=True)
-                return None
+            retry_status = r.status_code in RETRY_STATUS
+            if 'Backoff' not in r.headers and not retry_status:
+                try:
+                    return callback(r.json())
+                except BaseException as e:
+                    logger.error('Buildhub query failed with parameters: '
+                                 '{}.'.format(params))
+                    logger.error(e, exc_info=True)
+                    return None
+            delay = get_delay(r.headers, sleep, attempt)
+
+        if time.time() + delay > deadline:
+            logger.error('Too long to wait in buildhub.make_request '
+                         '({}s)'.format(MAX_RETRY_TIME))
+            return None
+        time.sleep(delay)
 
     logger.error('Too many attempts in buildhub.make_request (retry={})'.format(retry))
 
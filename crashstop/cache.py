@@ -3,14 +3,24 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from bmemcached import Client
+from collections import OrderedDict
+from concurrent.futures import Future
+import functools
 import hashlib
 from itertools import chain
 import os
+import threading
 import time
-from . import config, signatures
+from . import config, models, serializers, signatures, utils
 from .logger import logger
 
 
+LASTDATE_KEY = 'crashstop-lastdate'
+FILTERS = ['all', 'successful', 'unsuccessful']
+# to bump when the format of the cached data changes
+CACHE_FORMAT = '2'
+
+
 __CLIENT = Client(os.environ.get('MEMCACHEDCLOUD_SERVERS', config.get_memcached('servers')).split(','),
                   os.environ.get('MEMCACHEDCLOUD_USERNAME', config.get_memcached('username')),
                   os.environ.get('MEMCACHEDCLOUD_PASSWORD', config.get_memcached('password')))
@@ -22,15 +32,17 @@ def get_client():
 
 def get_value(hgurls, sgns, extra):
     data = signatures.get_for_urls_sgns(hgurls, sgns, [], extra=extra, sumup=True)
-    data, links, versions, affected, has_extra = signatures.prepare_bug_for_html(data, extra)
-    return (data, links, versions, affected, has_extra)
+    return signatures.prepare_bug_for_html(data, extra)
+
+
+def get_values(queries, extra):
+    data = signatures.get_for_sumups(queries, extra=extra)
+    return [signatures.prepare_bug_for_html(d, extra) for d in data]
 
 
 def get_hash(key):
     key = key.encode('utf-8')
-    md5 = hashlib.md5(key).hexdigest()
-    sha1 = hashlib.sha1(key).hexdigest()
-    return md5 + sha1 + str(len(key))
+    return hashlib.blake2b(key, digest_size=20).hexdigest()
 
 
 def get_extra_as_list(extra):
@@ -46,41 +58,423 @@ def get_extra_as_list(extra):
     return res
 
 
-def get_sumup(hg_urls, signatures, extra):
-    key = '\n'.join(chain(signatures,
+class SingleFlight(object):
+    """Coalesce the concurrent calls for the same key in this process"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, f):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = Future()
+
+        if not leader:
+            incr('coalesced')
+            return call.result()
+
+        try:
+            value = f()
+            call.set_result(value)
+            return value
+        except BaseException as e:
+            call.set_exception(e)
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+
+class LocalCache(object):
+    """An in-process LRU in front of memcached for the fresh sumup entries.
+
+       The entries are kept deserialized, the total size (of the serialized
+       entries) is bounded by max_bytes and an entry is removed once it isn't
+       fresh anymore. All the entries are dropped when the last date of the
+       update changes (checked every check_time seconds).
+    """
+
+    def __init__(self, max_bytes, check_time):
+        self.max_bytes = max_bytes
+        self.check_time = check_time
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.last_date = None
+        self.next_check = 0
+
+    def check(self):
+        now = time.time()
+        if now < self.next_check:
+            return
+        self.next_check = now + self.check_time
+        last_date = get_last_date()
+        with self.lock:
+            if last_date != self.last_date:
+                self.last_date = last_date
+                self.entries.clear()
+                self.size = 0
+
+    def get(self, key):
+        self.check()
+        with self.lock:
+            x = self.entries.get(key)
+            if x is None:
+                return None
+            entry, size = x
+            if time.time() >= entry[0]:
+                del self.entries[key]
+                self.size -= size
+                return None
+            self.entries.move_to_end(key)
+            return entry
+
+    def put(self, key, entry, size):
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            x = self.entries.pop(key, None)
+            if x is not None:
+                self.size -= x[1]
+            self.entries[key] = (entry, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, s) = self.entries.popitem(last=False)
+                self.size -= s
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+            self.next_check = 0
+
+
+__FLIGHTS = SingleFlight()
+__SERIALIZER = serializers.get_serializer()
+__LOCAL = LocalCache(config.get_local_cache_size(),
+                     config.get_local_cache_check())
+__METRICS = {'hits': 0, 'local_hits': 0, 'misses': 0, 'coalesced': 0,
+             'stale': 0, 'precomputed': 0}
+__METRICS_LOCK = threading.Lock()
+
+
+def incr(metric):
+    with __METRICS_LOCK:
+        __METRICS[metric] += 1
+
+
+def get_metrics():
+    with __METRICS_LOCK:
+        return dict(__METRICS)
+
+
+def get_sumup_key(hg_urls, signatures, extra):
+    key = '\n'.join(chain([CACHE_FORMAT],
+                          signatures,
                           hg_urls,
                           get_extra_as_list(extra)))
-    key = get_hash(key)
+    return get_hash(key)
+
+
+def get_local():
+    return __LOCAL
+
+
+def get_entry(key):
+    """Get (fresh_until, value) from the local cache or from memcached"""
+    entry = __LOCAL.get(key)
+    if entry is not None:
+        incr('local_hits')
+        return entry
+
+    data = get_client().get(key)
+    entry = __SERIALIZER.loads(data)
+    if isinstance(entry, tuple) and len(entry) == 2:
+        if time.time() < entry[0]:
+            __LOCAL.put(key, entry, len(data))
+        return entry
+    return None
+
+
+def set_value(key, hg_urls, signatures, extra):
+    value = get_value(hg_urls, signatures, extra)
+    put_value(key, value)
+    return value
+
+
+def put_value(key, value):
+    cache_time = config.get_cache_time()
+    entry = (time.time() + cache_time, value)
+    data = __SERIALIZER.dumps(entry)
+    # the value is already compressed by the serializer
+    get_client().set(key, data,
+                     time=cache_time + config.get_stale_time(),
+                     compress_level=0)
+    __LOCAL.put(key, entry, len(data))
+
+
+def refresh(key, lease, hg_urls, signatures, extra):
+    """Refresh the value in background, the lease is released at the end"""
+    from . import app
+
+    def target():
+        try:
+            with app.app_context():
+                set_value(key, hg_urls, signatures, extra)
+        except Exception:
+            logger.error('Cannot refresh the sumup cache', exc_info=True)
+        finally:
+            get_client().delete(lease)
+
+    threading.Thread(target=target, daemon=True).start()
+
+
+def wait_for(key, lease):
+    """Wait (at most lease_wait seconds) for the value computed elsewhere"""
     bcache = get_client()
-    for _ in [0, 1]:
-        if bcache.add(key, 0, time=30):
-            try:
-                value = get_value(hg_urls, signatures, extra)
-            except Exception:
-                bcache.delete(key)
-                raise
-            bcache.set(key, value,
-                       time=config.get_cache_time(),
-                       compress_level=9)
-            return value
-        else:
-            # since add returned False, it means that the key is already here
-            while True:
-                value = bcache.get(key)
-                if value is None:
-                    # key has expired
-                    break
-                if value != 0:
-                    # we've a correct value
-                    return value
-                time.sleep(0.1)
-
-    # if we're here then it means that value is two times None...
-    # so probably the memcached server is down
+    deadline = time.time() + config.get_lease_wait()
+    sleep = 0.05
+    while time.time() < deadline:
+        time.sleep(sleep)
+        sleep = min(2. * sleep, 1.)
+        entry = get_entry(key)
+        if entry is not None:
+            return entry
+        if bcache.get(lease) is None:
+            # the lease has been released or memcached is down
+            break
+
+    return get_entry(key)
+
+
+def get_sumup_helper(key, entry, hg_urls, signatures, extra):
+    bcache = get_client()
+    lease = key + '-lease'
+    if bcache.add(lease, 1, time=config.get_lease_time()):
+        # we're in charge of the refresh
+        if entry is not None:
+            incr('stale')
+            refresh(key, lease, hg_urls, signatures, extra)
+            return entry[1]
+
+        incr('misses')
+        try:
+            return set_value(key, hg_urls, signatures, extra)
+        finally:
+            bcache.delete(lease)
+
+    if entry is not None:
+        # someone else is refreshing the value
+        incr('stale')
+        return entry[1]
+
+    entry = wait_for(key, lease)
+    if entry is not None:
+        incr('coalesced')
+        return entry[1]
+
+    # the value isn't here: the other worker failed
+    # or probably the memcached server is down
     logger.warning('Issue with memcached...')
+    incr('misses')
 
     return get_value(hg_urls, signatures, extra)
 
 
+def get_precomputed(bugs):
+    """Get the values computed during the update for the bugs and put them
+       in the cache. The bugs without a value for these inputs are added to
+       the ones to compute during the next update.
+
+       Args:
+           bugs (dict): bugid => (key, hg_urls, signatures)
+       Returns:
+           dict: bugid => value
+    """
+    values = models.Sumup.get({bugid: i[0] for bugid, i in bugs.items()})
+    models.Sumup.add({bugid: i for bugid, i in bugs.items()
+                      if bugid not in values})
+    for bugid, value in values.items():
+        incr('precomputed')
+        put_value(bugs[bugid][0], value)
+    return values
+
+
+def get_sumup(hg_urls, signatures, extra, bugid=None):
+    """Get the data for sumup.html.
+
+       A value is fresh during cache_time and then can be served as stale
+       during stale_time while it's refreshed.
+       When the value isn't fresh, the data precomputed during the update
+       are used if we've them for the bug and for the same inputs (and there
+       is no extra parameter).
+       Only one worker (the one holding the lease) computes a value and the
+       concurrent requests in the same process are coalesced.
+    """
+    key = get_sumup_key(hg_urls, signatures, extra)
+    entry = get_entry(key)
+    if entry is not None and time.time() < entry[0]:
+        incr('hits')
+        return entry[1]
+
+    if bugid and not extra:
+        values = get_precomputed({bugid: (key, hg_urls, signatures)})
+        if bugid in values:
+            return values[bugid]
+
+    f = functools.partial(get_sumup_helper, key, entry,
+                          hg_urls, signatures, extra)
+    return __FLIGHTS.do(key, f)
+
+
+def get_sumups(queries, extra):
+    """Get the data for sumup.html for several bugs.
+
+       The entries (and the precomputed data) are the ones used by get_sumup
+       and the duplicated queries are merged. The missing values are computed
+       together, so the hg revisions and the signatures of all the bugs are
+       queried only once.
+
+       Args:
+           queries (list): the (bugid, hg_urls, signatures)
+       Returns:
+           list: the data for each query
+    """
+    res = [None] * len(queries)
+    indices = OrderedDict()
+    args = {}
+    for n, (bugid, hg_urls, sgns) in enumerate(queries):
+        key = get_sumup_key(hg_urls, sgns, extra)
+        if key not in indices:
+            indices[key] = []
+            args[key] = (hg_urls, sgns)
+        indices[key].append((n, bugid))
+
+    values = {}
+    entries = OrderedDict()
+    for key in indices.keys():
+        entry = get_entry(key)
+        if entry is not None and time.time() < entry[0]:
+            incr('hits')
+            values[key] = entry[1]
+        else:
+            entries[key] = entry
+
+    if not extra:
+        # the precomputed values of all the bugs are got in one query
+        bugs = {bugid: (key, ) + args[key]
+                for key in entries.keys()
+                for _, bugid in indices[key] if bugid}
+        for bugid, value in get_precomputed(bugs).items():
+            key = bugs[bugid][0]
+            values[key] = value
+            entries.pop(key, None)
+
+    bcache = get_client()
+    tocompute = []
+    towait = []
+    for key, entry in entries.items():
+        if bcache.add(key + '-lease', 1, time=config.get_lease_time()):
+            incr('misses' if entry is None else 'stale')
+            tocompute.append(key)
+        elif entry is not None:
+            # someone else is refreshing the value
+            incr('stale')
+            values[key] = entry[1]
+        else:
+            towait.append(key)
+
+    try:
+        if tocompute:
+            computed = get_values([args[key] for key in tocompute], extra)
+            for key, value in zip(tocompute, computed):
+                put_value(key, value)
+                values[key] = value
+    finally:
+        for key in tocompute:
+            bcache.delete(key + '-lease')
+
+    failed = []
+    for key in towait:
+        entry = wait_for(key, key + '-lease')
+        if entry is not None:
+            incr('coalesced')
+            values[key] = entry[1]
+        else:
+            incr('misses')
+            failed.append(key)
+
+    if failed:
+        logger.warning('Issue with memcached...')
+        computed = get_values([args[key] for key in failed], extra)
+        values.update(zip(failed, computed))
+
+    for key, ns in indices.items():
+        for n, _ in ns:
+            res[n] = values[key]
+
+    return res
+
+
+def get_last_date():
+    """Get the date of the last update (it's the key of the cached data)"""
+    bcache = get_client()
+    last_date = bcache.get(LASTDATE_KEY)
+    if last_date is None:
+        last_date = models.Lastdate.get()
+        bcache.set(LASTDATE_KEY, last_date, time=config.get_cache_time())
+    return last_date
+
+
+def get_signatures_key(product, channel, filt, last_date):
+    key = '\n'.join(['signatures', CACHE_FORMAT, product, channel, filt,
+                     str(last_date)])
+    return get_hash(key)
+
+
+def get_signatures_value(product, channel, filt):
+    data = models.Signatures.get_bypc(product, channel, filt)
+    return signatures.prepare_signatures_for_html(data, product, channel)
+
+
+def get_signatures(product, channel, filt):
+    """Get the data for signatures.html, they're computed only once
+       per update"""
+    last_date = get_last_date()
+    key = get_signatures_key(product, channel, filt, last_date)
+    bcache = get_client()
+    value = bcache.get(key)
+    if value is None:
+        value = get_signatures_value(product, channel, filt)
+        bcache.set(key, value, time=config.get_sgns_cache_time())
+    return value
+
+
+def warm_signatures(last_date):
+    """Put the data for signatures.html in the cache for the new update"""
+    logger.info('Warm signatures cache: started.')
+    bcache = get_client()
+    for product in utils.get_products():
+        for channel in utils.get_channels():
+            for filt in FILTERS:
+                try:
+                    value = get_signatures_value(product, channel, filt)
+                except Exception:
+                    logger.error('Cannot get signatures for {}-{} ({})'
+                                 .format(product, channel, filt),
+                                 exc_info=True)
+                    continue
+                key = get_signatures_key(product, channel, filt, last_date)
+                bcache.set(key, value, time=config.get_sgns_cache_time())
+
+    # the new data are ready so we can use them
+    bcache.set(LASTDATE_KEY, last_date, time=config.get_cache_time())
+    logger.info('Warm signatures cache: finished.')
+
+
 def clear():
+    __LOCAL.clear()
     get_client().flush_all()
@@ -69,10 +69,82 @@ def get_limit_facets():
     return _get_global()['facets_limit']
 
 
+def get_max_workers():
+    return _get_global()['max_workers']
+
+
+def get_max_url_length():
+    return _get_global()['max_url_length']
+
+
+def get_incremental():
+    return _get_global()['incremental']
+
+
+def get_hot_buildids():
+    return _get_global()['hot_buildids']
+
+
 def get_cache_time():
     return _get_global()['cache_time']
 
 
+def get_stale_time():
+    return _get_global()['stale_time']
+
+
+def get_cache_serializer():
+    return _get_global()['cache_serializer']
+
+
+def get_cache_compress_level():
+    return _get_global()['cache_compress_level']
+
+
+def get_local_cache_size():
+    return _get_global()['local_cache_size']
+
+
+def get_local_cache_check():
+    return _get_global()['local_cache_check']
+
+
+def get_revision_ttl():
+    return _get_global()['revision_ttl']
+
+
+def get_patchinfo_chunk_size():
+    return _get_global()['patchinfo_chunk_size']
+
+
+def get_bugzilla_shard_days():
+    return _get_global()['bugzilla_shard_days']
+
+
+def get_bugzilla_workers():
+    return _get_global()['bugzilla_workers']
+
+
+def get_lease_time():
+    return _get_global()['lease_time']
+
+
+def get_lease_wait():
+    return _get_global()['lease_wait']
+
+
+def get_sgns_cache_time():
+    return _get_global()['sgns_cache_time']
+
+
+def get_sumups_max_bugs():
+    return _get_global()['sumups_max_bugs']
+
+
+def get_sumup_max_rows():
+    return _get_global()['sumup_max_rows']
+
+
 def get_database():
     return _get_local().get('database', '')
 
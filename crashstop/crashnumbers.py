@@ -0,0 +1,98 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import numpy as np
+from .utils import PLATFORMS
+
+
+class CrashNumbers(object):
+    """Crash numbers for the signatures of a product/channel.
+
+       The numbers are stored in arrays with one row per signature and one
+       column per buildid. When details are required, we've also the startup
+       crash rates and the crash numbers per platform (in PLATFORMS order).
+    """
+
+    __slots__ = ('signatures', 'index', 'buildids', 'columns',
+                 'raw', 'installs', 'startup', 'platforms', 'seen')
+
+    def __init__(self, signatures, buildids, details=False):
+        self.signatures = list(signatures)
+        self.index = {s: i for i, s in enumerate(self.signatures)}
+        self.buildids = list(buildids)
+        self.columns = {b: i for i, b in enumerate(self.buildids)}
+        S, B = len(self.signatures), len(self.buildids)
+        self.raw = np.zeros((S, B), dtype=np.int32)
+        self.installs = np.zeros((S, B), dtype=np.int32)
+        if details:
+            self.startup = np.zeros((S, B), dtype=np.int32)
+            self.platforms = np.zeros((S, B, len(PLATFORMS)), dtype=np.int32)
+            # True when the signature has crashes in the product/channel
+            self.seen = np.zeros(S, dtype=bool)
+        else:
+            self.startup = self.platforms = self.seen = None
+
+    def __len__(self):
+        return len(self.signatures)
+
+    def __iter__(self):
+        return iter(self.signatures)
+
+    def __contains__(self, signature):
+        return signature in self.index
+
+    @staticmethod
+    def from_facets(buildids, facets):
+        """Get the numbers from facets.
+
+           Args:
+               buildids (list): the buildids
+               facets (list): for each buildid {signature: [raw, installs]}
+        """
+        signatures = set()
+        for numbers in facets:
+            signatures.update(numbers.keys())
+
+        res = CrashNumbers(sorted(signatures), buildids)
+        for col, numbers in enumerate(facets):
+            if not numbers:
+                continue
+            rows = [res.index[s] for s in numbers.keys()]
+            values = np.array(list(numbers.values()), dtype=np.int32)
+            res.raw[rows, col] = values[:, 0]
+            res.installs[rows, col] = values[:, 1]
+
+        return res
+
+    def select(self, signatures):
+        """Get the numbers for the signatures which are in signatures"""
+        if len(signatures) < len(self.signatures):
+            rows = sorted(self.index[s] for s in signatures
+                          if s in self.index)
+        else:
+            rows = [i for i, s in enumerate(self.signatures)
+                    if s in signatures]
+        res = CrashNumbers([], self.buildids)
+        res.signatures = [self.signatures[i] for i in rows]
+        res.index = {s: i for i, s in enumerate(res.signatures)}
+        res.raw = self.raw[rows]
+        res.installs = self.installs[rows]
+        if self.seen is not None:
+            res.startup = self.startup[rows]
+            res.platforms = self.platforms[rows]
+            res.seen = self.seen[rows]
+        return res
+
+    def set_platforms(self, row, col, platforms):
+        """Set the numbers from a dict platform => count"""
+        self.platforms[row, col] = [platforms.get(p, 0) for p in PLATFORMS]
+
+    def get_platforms(self, row):
+        """Get a dict platform => count for all the buildids"""
+        totals = self.platforms[row].sum(axis=0).tolist()
+        return {p: n for p, n in zip(PLATFORMS, totals) if n}
+
+    def get_raw_installs(self, signature):
+        row = self.index[signature]
+        return self.raw[row].tolist(), self.installs[row].tolist()
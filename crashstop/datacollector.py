@@ -7,11 +7,13 @@ import copy
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 import functools
+import threading
+import time
 from libmozdata import socorro, utils as lmdutils
 from libmozdata.connection import Query, Connection
 from libmozdata.hgmozilla import Revision
-from . import config, utils, tools
-from .const import RAW, INSTALLS, PLATFORMS, STARTUP
+from . import config, models, streaming, utils, tools
+from .crashnumbers import CrashNumbers
 from .logger import logger
 
 
@@ -69,72 +71,244 @@ def filter_nightly_buildids(buildids):
         buildids[prod]['nightly'] = [x[0] for x in L if x[1]]
 
 
-def get_sgns_by_buildid(signatures, channels, products, search_date, bids):
-    base = utils.get_base_list(bids)
+def get_ratios(channels, products, search_date, bids,
+               timings=None, facets=None):
+    """Get the global ratio of each product/channel.
+
+       For each buildid, we only get the top signatures with their number
+       of installs (cardinality), which is enough to compute the ratios.
+       All the queries are submitted at once to a single pool of workers
+       (its size is max_workers in global.json) and the global ratio of a
+       channel is computed as soon as all its queries are done.
+
+       Args:
+           timings (list): if not None, will receive a
+                           (product, channel, buildid, seconds) for each query
+                           where seconds is the time taken by the query.
+           facets (dict): if not None, the known facets:
+                          product => channel => {datetime(buildid): (fetched,
+                                                 {signature: [raw, installs]})}
+                          they're used instead of querying Socorro except for
+                          the last hot_buildids (global.json) of each channel.
+                          The fetched facets are put in this dict.
+    """
     limit = config.get_limit_facets()
+    hot = config.get_hot_buildids()
+    lock = threading.Lock()
+    start = time.time()
+    now = lmdutils.as_utc(datetime.utcnow())
 
-    logger.info('Get crash numbers for {}-{}: started.'.format(products,
+    logger.info('Get global ratios for {}-{}: started.'.format(products,
                                                                channels))
 
-    def handler(base, index, json, data):
-        if not json['facets']['signature']:
-            return
-        for facets in json['facets']['signature']:
-            sgn = facets['term']
-            if sgn not in data:
-                data[sgn] = copy.deepcopy(base)
-            data[sgn][index][RAW] = facets['count']
-            facets = facets['facets']
-            n = len(facets['install_time'])
-            if n == limit:
-                n = facets['cardinality_install_time']['value']
-            data[sgn][index][INSTALLS] = n
+    def handler(pc, index, json, data):
+        numbers = {}
+        if json['facets']['signature']:
+            for facet in json['facets']['signature']:
+                sgn = facet['term']
+                raw = facet['count']
+                n = facet['facets']['cardinality_install_time']['value']
+                numbers[sgn] = [raw, n]
+
+        with lock:
+            data[index] = numbers
+            prod, chan = pc
+            bid = bids[prod][chan][index][0]
+            if facets is not None:
+                facets[prod][chan][bid] = (now, numbers)
+            if timings is not None:
+                timings.append((prod, chan, utils.get_buildid(bid),
+                                json['elapsed']))
+            remaining[pc] -= 1
+            if remaining[pc] == 0:
+                channel_done(pc, data)
+
+    def channel_done(pc, data):
+        prod, chan = pc
+        buildids = [b[0] for b in bids[prod][chan]]
+        data = CrashNumbers.from_facets(buildids, data)
+        ratios[prod][chan] = tools.get_global_ratios(data)
+        logger.info('Global ratio for {}-{} computed in {}s.'.format(
+            prod, chan, round(time.time() - start, 2)))
 
     base_params = {'product': '',
                    'release_channel': '',
                    'build_id': '',
                    'date': search_date,
-                   '_aggs.signature': ['install_time',
-                                       '_cardinality.install_time'],
+                   '_aggs.signature': '_cardinality.install_time',
                    '_results_number': 0,
                    '_facets': 'release_channel',
                    '_facets_size': limit}
 
     ratios = {}
-    res = {}
+    remaining = {}
+    queries = []
+    to_finish = []
 
     for prod in products:
         pparams = copy.deepcopy(base_params)
         pparams['product'] = prod
-        base_prod = base[prod]
         bids_prod = bids[prod]
-        ratios[prod] = ratios_prod = {}
-        res[prod] = res_prod = {}
+        ratios[prod] = {}
+        if facets is not None and prod not in facets:
+            facets[prod] = {}
         for chan in channels:
             if chan not in bids_prod:
                 continue
 
             params = copy.deepcopy(pparams)
             params['release_channel'] = chan
-            data = {}
             sbids = [b[0] for b in bids_prod[chan]]
-            queries = []
+            data = [{} for _ in sbids]
+            known = {}
+            if facets is not None:
+                if chan not in facets[prod]:
+                    facets[prod][chan] = {}
+                known = facets[prod][chan]
+            first_hot = max(0, len(sbids) - hot)
+            remaining[(prod, chan)] = 0
             for index, bid in enumerate(sbids):
+                if index < first_hot and bid in known:
+                    data[index] = known[bid][1]
+                    continue
+
+                remaining[(prod, chan)] += 1
                 params = copy.deepcopy(params)
                 params['build_id'] = utils.get_buildid(bid)
-                hdler = functools.partial(handler, base_prod[chan], index)
+                hdler = functools.partial(handler, (prod, chan), index)
                 queries.append(Query(socorro.SuperSearch.URL,
                                      params=params,
                                      handler=hdler,
                                      handlerdata=data))
-            socorro.SuperSearch(queries=queries).wait()
-            ratios_prod[chan] = tools.get_global_ratios(data)
 
-            # now we've ratios, we can remove useless signatures
-            res_prod[chan] = {s: n for s, n in data.items() if s in signatures}
+            if remaining[(prod, chan)] == 0:
+                to_finish.append(((prod, chan), data))
+
+    for pc, data in to_finish:
+        channel_done(pc, data)
 
-    logger.info('Get crash numbers for {}-{}: finished.'.format(products,
+    if queries:
+        logger.info('{} queries to get global ratios.'.format(len(queries)))
+        streaming.SuperSearch(field='signature',
+                              queries=queries,
+                              max_workers=config.get_max_workers()).wait()
+
+    logger.info('Get global ratios for {}-{}: finished.'.format(products,
                                                                 channels))
+    return ratios
+
+
+def get_sgns_numbers(signatures, channels, products, search_date, bids,
+                     timings=None):
+    """Get the crash numbers (a CrashNumbers) for the signatures in each
+       product/channel.
+
+       The signatures are queried by batches, for all the buildids of a
+       channel at once, with nested build_id aggregations. Only the
+       signatures with crashes are in the results.
+
+       Args:
+           timings (list): if not None, will receive a
+                           (product, channel, signatures, seconds) for each
+                           query where signatures is the number of signatures
+                           in the batch and seconds the time taken by the
+                           query.
+    """
+    limit = config.get_limit_facets()
+    max_length = config.get_max_url_length()
+    lock = threading.Lock()
+    start = time.time()
+
+    logger.info('Get crash numbers for {} signatures: started.'
+                .format(len(signatures)))
+
+    def handler(pc, sgns, columns, json, data):
+        with lock:
+            if timings is not None:
+                timings.append(pc + (len(sgns), json['elapsed']))
+            if not json['facets']['signature']:
+                return
+            for facet in json['facets']['signature']:
+                sgn = facet['term']
+                if sgn not in sgns:
+                    continue
+                for bucket in facet['facets']['build_id']:
+                    col = columns.get(utils.get_build_date(bucket['term']))
+                    if col is None:
+                        continue
+                    raw = bucket['count']
+                    bucket = bucket['facets']
+                    n = len(bucket['install_time'])
+                    if n == limit:
+                        n = bucket['cardinality_install_time']['value']
+                    data[col][sgn] = [raw, n]
+
+    base_params = {'product': '',
+                   'release_channel': '',
+                   'build_id': '',
+                   'signature': '',
+                   'date': search_date,
+                   '_aggs.signature.build_id': ['install_time',
+                                                '_cardinality.install_time'],
+                   '_results_number': 0,
+                   '_facets': 'release_channel',
+                   '_facets_size': limit}
+
+    data = {}
+    queries = []
+    for prod in products:
+        bids_prod = bids[prod]
+        data[prod] = {}
+        for chan in channels:
+            if chan not in bids_prod:
+                continue
+
+            sbids = [b[0] for b in bids_prod[chan]]
+            columns = {b: i for i, b in enumerate(sbids)}
+            data[prod][chan] = data_pc = [{} for _ in sbids]
+            params = copy.deepcopy(base_params)
+            params['product'] = prod
+            params['release_channel'] = chan
+            params['build_id'] = [utils.get_buildid(b) for b in sbids]
+            for sgns in utils.chunk_signatures(sorted(signatures), limit,
+                                               max_length):
+                params = copy.deepcopy(params)
+                params['signature'] = ['=' + s for s in sgns]
+                hdler = functools.partial(handler, (prod, chan), set(sgns),
+                                          columns)
+                queries.append(Query(socorro.SuperSearch.URL,
+                                     params=params,
+                                     handler=hdler,
+                                     handlerdata=data_pc))
+
+    if queries:
+        logger.info('{} queries to get crash numbers.'.format(len(queries)))
+        counted = ['facets.build_id.item.facets.install_time']
+        streaming.SuperSearch(field='signature',
+                              counted=counted,
+                              queries=queries,
+                              max_workers=config.get_max_workers()).wait()
+
+    res = {}
+    for prod, i in data.items():
+        res[prod] = {}
+        for chan, data_pc in i.items():
+            buildids = [b[0] for b in bids[prod][chan]]
+            res[prod][chan] = CrashNumbers.from_facets(buildids, data_pc)
+
+    logger.info('Get crash numbers: finished in {}s.'
+                .format(round(time.time() - start, 2)))
+
+    return res
+
+
+def get_sgns_by_buildid(signatures, channels, products, search_date, bids,
+                        timings=None, facets=None):
+    """Get the crash numbers for the signatures and the global ratios
+       in each product/channel."""
+    ratios = get_ratios(channels, products, search_date, bids,
+                        timings=timings, facets=facets)
+    res = get_sgns_numbers(signatures, channels, products, search_date, bids)
     return res, ratios
 
 
@@ -154,38 +328,80 @@ def analyze_uptime(histo):
     return res
 
 
-def get_sgns_data_helper(data, signatures, bids, nbase, extra, search_date, product=None, channel=None):
+class Pending(object):
+    """Queries to wait for, then the ones they may have triggered"""
+
+    def __init__(self, conn, then):
+        self.conn = conn
+        self.then = then
+
+    def wait(self):
+        self.conn.wait()
+        conn = self.then()
+        if conn is not None:
+            conn.wait()
+
+
+def get_sgns_data_helper(data, signatures, bids, extra, search_date,
+                         product=None, channel=None):
+    """Get the crash data for the signatures.
+
+       The signatures are queried by batches with a signature facet and
+       nested build_id aggregations. The signatures with too many buildids
+       in the batched results are queried again one by one.
+    """
     limit = 80
+    aggs = ['install_time',
+            '_cardinality.install_time',
+            'startup_crash',
+            'platform_pretty_version']
 
-    def handler(sgn, bids, nbase, json, data):
-        if not json['facets']['build_id']:
-            return
-        for facets in json['facets']['build_id']:
+    def put_numbers(sgn, bids, buckets, data):
+        for facets in buckets:
             rawbid = facets['term']
             bid = utils.get_build_date(rawbid)
             prod, chan = bids[bid]
-            dpc = data[prod][chan]
-            nums = dpc[sgn]
-            if isinstance(nums, list):
-                dpc[sgn] = nums = {b: copy.copy(nbase) for b in dpc[sgn]}
-            if bid in nums:
-                n = nums[bid]
-                n[RAW] = facets['count']
+            nums = data[prod][chan]
+            row = nums.index[sgn]
+            nums.seen[row] = True
+            col = nums.columns.get(bid)
+            if col is not None:
+                nums.raw[row, col] = facets['count']
                 facets = facets['facets']
                 N = len(facets['install_time'])
                 if N == limit:
                     N = facets['cardinality_install_time']['value']
-                n[INSTALLS] = N
-                n[STARTUP] = utils.startup_crash_rate(facets['startup_crash'])
-                n[PLATFORMS] = utils.analyze_platforms(facets['platform_pretty_version'])
+                nums.installs[row, col] = N
+                startup = utils.startup_crash_rate(facets['startup_crash'])
+                nums.startup[row, col] = startup
+                platforms = facets['platform_pretty_version']
+                platforms = utils.analyze_platforms(platforms)
+                nums.set_platforms(row, col, platforms)
+
+    def handler(sgn, bids, json, data):
+        if not json['facets']['build_id']:
+            return
+        put_numbers(sgn, bids, json['facets']['build_id'], data)
+
+    def batch_handler(sgns, bids, json, data):
+        if not json['facets']['signature']:
+            return
+        for facets in json['facets']['signature']:
+            sgn = facets['term']
+            if sgn not in sgns:
+                continue
+            buckets = facets['facets']['build_id']
+            if len(buckets) >= limit:
+                # some buildids are probably missing
+                with lock:
+                    too_many.append(sgn)
+            else:
+                put_numbers(sgn, bids, buckets, data)
 
     base_params = {'build_id': [utils.get_buildid(bid) for bid in bids.keys()],
                    'signature': '',
                    'date': search_date,
-                   '_aggs.build_id': ['install_time',
-                                      '_cardinality.install_time',
-                                      'startup_crash',
-                                      'platform_pretty_version'],
+                   '_aggs.build_id': aggs,
                    '_results_number': 0,
                    '_facets': 'signature',
                    '_facets_size': limit}
@@ -197,26 +413,56 @@ def get_sgns_data_helper(data, signatures, bids, nbase, extra, search_date, prod
 
     utils.update_params(base_params, extra)
 
+    batch_params = copy.deepcopy(base_params)
+    del batch_params['_aggs.build_id']
+    batch_params['_aggs.signature.build_id'] = aggs
+    # we don't want the default signature facet
+    batch_params['_facets'] = 'release_channel'
+
+    def get_queries(signatures):
+        queries = []
+        for signature in signatures:
+            params = copy.deepcopy(base_params)
+            params['signature'] = '=' + signature
+            hdler = functools.partial(handler, signature, bids)
+            queries.append(Query(socorro.SuperSearch.URL,
+                                 params=params,
+                                 handler=hdler,
+                                 handlerdata=data))
+        return queries
+
+    def fallback():
+        if not too_many:
+            return None
+        return streaming.SuperSearch(field='build_id',
+                                     counted=['facets.install_time'],
+                                     queries=get_queries(too_many))
+
+    lock = threading.Lock()
+    too_many = []
     queries = []
 
-    for signature in signatures:
-        params = copy.deepcopy(base_params)
-        params['signature'] = '=' + signature
-        hdler = functools.partial(handler, signature, bids, nbase)
+    max_length = config.get_max_url_length()
+    for sgns in utils.chunk_signatures(sorted(signatures), limit, max_length):
+        params = copy.deepcopy(batch_params)
+        params['signature'] = ['=' + s for s in sgns]
+        hdler = functools.partial(batch_handler, set(sgns), bids)
         queries.append(Query(socorro.SuperSearch.URL,
                              params=params,
                              handler=hdler,
                              handlerdata=data))
 
-    res = socorro.SuperSearch(queries=queries)
-    return res
+    counted = ['facets.build_id.item.facets.install_time']
+    res = streaming.SuperSearch(field='signature',
+                                counted=counted,
+                                queries=queries)
+    return Pending(res, fallback)
 
 
 def get_sgns_data(channels, versions, signatures, extra, products, towait, date='today'):
     today = lmdutils.get_date_ymd(date)
     few_days_ago = today - relativedelta(days=config.get_limit())
     search_date = socorro.SuperSearch.get_search_date(few_days_ago)
-    nbase = [0, 0, 0, {}]
     data = {}
     unique = {}
     unique_prod = defaultdict(lambda: dict())
@@ -241,15 +487,13 @@ def get_sgns_data(channels, versions, signatures, extra, products, towait, date=
         data[product] = d1 = {}
         b1 = allbids[product]
         for chan in channels:
-            d1[chan] = d2 = {}
-            b2 = b1[chan]
-            for signature in signatures:
-                d2[signature] = b2
+            d1[chan] = CrashNumbers(signatures, sorted(b1[chan]),
+                                    details=True)
 
     if not unique_prod:
         # if we've only unique buildids: only N queries for the N signatures
         towait.append(get_sgns_data_helper(data, signatures, unique,
-                                           nbase, extra, search_date))
+                                           extra, search_date))
     else:
         # if a buildid is unique then it's unique for its product too.
         # So we've only 2xN queries (2 == len(['Firefox', 'FennecAndroid']))
@@ -258,7 +502,7 @@ def get_sgns_data(channels, versions, signatures, extra, products, towait, date=
             unique_prod[p][b] = (p, c)
         for prod, bids in unique_prod.items():
             towait.append(get_sgns_data_helper(data, signatures, bids,
-                                               nbase, extra, search_date,
+                                               extra, search_date,
                                                product=prod))
 
     # handle the leftovers: normally they should be pretty rare
@@ -266,36 +510,68 @@ def get_sgns_data(channels, versions, signatures, extra, products, towait, date=
     for b, x in leftovers.items():
         prod, chan = x
         towait.append(get_sgns_data_helper(data, signatures, leftovers,
-                                           nbase, extra, search_date,
+                                           extra, search_date,
                                            product=prod, channel=chan))
 
     return data
 
 
-def get_pushdates(chan_rev):
+def get_revisions(chan_rev):
+    """Get the pushdates of the revisions and if they've been backed out.
 
-    def handler(json, data):
-        if not json['backedoutby']:
-            pushdate = json['pushdate'][0]
-            pushdate = lmdutils.as_utc(datetime.utcfromtimestamp(pushdate))
-            data.append(pushdate)
+       The revisions are looked up in the db and only the unknown ones are
+       queried on hg.mozilla.org, then they're stored in the db.
 
-    res = []
-    data = {}
+       Returns:
+           tuple: the pending queries and a dict (channel, revision) =>
+                  (pushdate, backedout) which is complete once the queries
+                  have been waited
+    """
+
+    def handler(key, json, data):
+        pushdate = json['pushdate'][0]
+        pushdate = lmdutils.as_utc(datetime.utcfromtimestamp(pushdate))
+        data[key] = (pushdate, bool(json['backedoutby']))
+
+    keys = [(chan, rev) for chan, revs in chan_rev.items() for rev in revs]
+    revisions = models.HgRevision.get(keys)
+    fetched = {}
+    queries = [Query(Revision.get_url(chan),
+                     params={'node': rev},
+                     handler=functools.partial(handler, (chan, rev)),
+                     handlerdata=fetched)
+               for chan, rev in keys if (chan, rev) not in revisions]
 
+    if not queries:
+        return [], revisions
+
+    logger.info('{} revisions in db and {} to get from hg.'
+                .format(len(revisions), len(queries)))
+    conn = Revision(queries=queries)
+
+    def then():
+        revisions.update(fetched)
+        models.HgRevision.put_data(fetched)
+
+    return [Pending(conn, then)], revisions
+
+
+def get_channel_pushdates(chan_rev, revisions):
+    """Get the pushdates of the revisions which haven't been backed out.
+
+       Returns:
+           dict: channel => [pushdate] (the esr channels are merged)
+    """
+    data = {}
     for chan, revs in chan_rev.items():
         if chan.startswith('esr'):
-            if 'esr' not in data:
-                data['esr'] = pd = []
-            else:
-                pd = data['esr']
+            pd = data.setdefault('esr', [])
         else:
             data[chan] = pd = []
 
         for rev in revs:
-            res.append(Revision(channel=chan,
-                                params={'node': rev},
-                                handler=handler,
-                                handlerdata=pd))
+            pushdate, backedout = revisions.get((chan, rev), (None, True))
+            if not backedout:
+                pd.append(pushdate)
 
-    return res, data
+    return data
@@ -2,9 +2,9 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from flask import request, render_template
+from flask import jsonify, request, render_template
 import json
-from . import utils, models, signatures, cache
+from . import config, utils, models, signatures, cache
 
 
 def sgns():
@@ -15,8 +15,7 @@ def sgns():
     filt = request.args.get('filter', 'all')
     filt = utils.get_correct_filter(filt)
 
-    data = models.Signatures.get_bypc(product, channel, filt)
-    signatures.prepare_signatures_for_html(data, product, channel)
+    data = cache.get_signatures(product, channel, filt)
 
     return render_template('signatures.html',
                            product=product,
@@ -25,21 +24,22 @@ def sgns():
                            channels=utils.get_channels(),
                            data=data,
                            filt=filt,
-                           enumerate=enumerate)
+                           enumerate=enumerate,
+                           crash_reports_link=utils.get_crash_reports_link)
 
 
 def bug():
     bugid = request.args.get('id', '')
     bugid = utils.get_bug_number(bugid)
     data = models.Signatures.get_bybugid(bugid)
-    data, links, versions, _, _ = signatures.prepare_bug_for_html(data)
+    data, versions, _, _ = signatures.prepare_bug_for_html(data)
 
     return render_template('bug.html',
                            data=data,
-                           links=links,
                            bugid=bugid,
                            versions=versions,
-                           enumerate=enumerate)
+                           enumerate=enumerate,
+                           crash_reports_link=utils.get_crash_reports_link)
 
 
 def crashdata():
@@ -48,14 +48,14 @@ def crashdata():
     products = request.args.getlist('products')
     products = utils.get_correct_products(products)
     data = signatures.get_for_urls_sgns(hgurls, sgns, products)
-    data, links, versions, _, _ = signatures.prepare_bug_for_html(data)
+    data, versions, _, _ = signatures.prepare_bug_for_html(data)
 
     return render_template('crashdata.html',
                            data=data,
-                           links=links,
                            versions=versions,
                            products=utils.get_products(),
-                           enumerate=enumerate)
+                           enumerate=enumerate,
+                           crash_reports_link=utils.get_crash_reports_link)
 
 
 def sumup():
@@ -63,15 +63,20 @@ def sumup():
     sgns = request.args.getlist('s')
     hgurls = request.args.getlist('h')
     addon_version = request.args.get('v', '')
+    bugid = utils.get_bug_number(request.args.get('id', ''))
     extra = dict(request.args)
-    for x in 'shv':
+    for x in ['s', 'h', 'v', 'id']:
         if x in extra:
             del extra[x]
 
-    data, links, versions, affected, has_extra = cache.get_sumup(hgurls, sgns, extra)
+    value = cache.get_sumup(hgurls, sgns, extra, bugid=bugid)
+    return render_sumup(value, addon_version)
+
+
+def render_sumup(value, addon_version):
+    data, versions, affected, has_extra = value
     return render_template('sumup.html',
                            data=data,
-                           links=links,
                            versions=versions,
                            affected=affected,
                            has_extra=has_extra,
@@ -79,4 +84,61 @@ def sumup():
                            addon_version=addon_version,
                            enumerate=enumerate,
                            zip=zip,
-                           jsonify=json.dumps)
+                           jsonify=json.dumps,
+                           crash_reports_link=utils.get_crash_reports_link)
+
+
+def is_str_list(x):
+    return isinstance(x, list) and all(isinstance(s, str) for s in x)
+
+
+def get_sumups_error(query):
+    """Check the posted json for sumups.json and get an error message
+       (None if it's correct)"""
+    if not isinstance(query, dict):
+        return 'The posted json must be an object.'
+    if not isinstance(query.get('v', ''), str):
+        return '\'v\' must be a string.'
+    if not isinstance(query.get('extra', {}), dict):
+        return '\'extra\' must be an object.'
+    bugs = query.get('bugs', [])
+    if not isinstance(bugs, list):
+        return '\'bugs\' must be a list.'
+    max_bugs = config.get_sumups_max_bugs()
+    if len(bugs) > max_bugs:
+        return 'Too many bugs: at most {} bugs can be asked.'.format(max_bugs)
+    for bug in bugs:
+        if not isinstance(bug, dict):
+            return 'A bug must be an object.'
+        if not is_str_list(bug.get('h', [])) or \
+           not is_str_list(bug.get('s', [])):
+            return '\'h\' and \'s\' must be lists of strings.'
+    return None
+
+
+def sumups():
+    """Get sumup.html for several bugs.
+
+       The posted json is {'bugs': [{'id': ..., 'h': [...], 's': [...]}],
+       'v': addon version, 'extra': {...}} and the html for each bug is
+       returned in the same order. At most sumups_max_bugs bugs can be
+       asked at once and a malformed query gets a 400.
+    """
+    query = request.get_json(force=True, silent=True)
+    if query is None:
+        query = {}
+    error = get_sumups_error(query)
+    if error:
+        return jsonify({'error': error}), 400
+
+    addon_version = query.get('v', '')
+    extra = query.get('extra', {})
+    bugs = query.get('bugs', [])
+    queries = []
+    for bug in bugs:
+        bugid = utils.get_bug_number(str(bug.get('id', '')))
+        queries.append((bugid, bug.get('h', []), bug.get('s', [])))
+
+    values = cache.get_sumups(queries, extra)
+    sumups = [render_sumup(v, addon_version) for v in values]
+    return jsonify({'sumups': sumups})
@@ -3,11 +3,13 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from collections import defaultdict
+from datetime import datetime, timedelta
 import sqlalchemy.dialects.postgresql as pg
-from sqlalchemy import and_, or_
+from sqlalchemy import (and_, case, inspect, literal, literal_column, or_,
+                        tuple_)
 import pytz
 import six
-from . import utils
+from . import config, utils
 from . import db, app
 from .logger import logger
 
@@ -64,29 +66,57 @@ class Buildid(db.Model):
 
     @staticmethod
     def add_buildids(data, commit=True):
+        """Synchronize the buildids in the db with the ones in data.
+
+           The buildids are upserted in one statement (version and unicity
+           are updated when they changed) and the buildids which aren't in
+           data anymore are removed for the products/channels in data.
+        """
         if not data:
             return
 
-        qs = db.session.query(Buildid)
-        here = defaultdict(lambda: defaultdict(lambda: set()))
-        for q in qs:
-            here[q.product][q.channel].add(q.buildid)
+        rows = []
+        pcs = []
         for prod, i in data.items():
-            here_p = here[prod]
             for chan, j in i.items():
-                here_pc = here_p[chan]
+                pcs.append((prod, chan))
                 for b, v, u, up in j:
-                    if b not in here_pc:
-                        db.session.add(Buildid(prod, chan, b, v, u, up))
-                    else:
-                        here_pc.remove(b)
-
-                if here_pc:
-                    q = db.session.query(Buildid)
-                    q = q.filter(Buildid.product == prod,
-                                 Buildid.channel == chan,
-                                 Buildid.buildid.in_(list(here_pc)))
-                    q.delete(synchronize_session='fetch')
+                    rows.append({'product': prod,
+                                 'channel': chan,
+                                 'buildid': b,
+                                 'version': v,
+                                 'unique': u,
+                                 'unique_prod': up})
+        if not pcs:
+            return
+
+        upserted = 0
+        if rows:
+            ins = pg.insert(Buildid).values(rows)
+            exc = ins.excluded
+            upd = ins.on_conflict_do_update(
+                index_elements=['product', 'channel', 'buildid'],
+                set_=dict(version=exc.version,
+                          unique=exc.unique,
+                          unique_prod=exc.unique_prod),
+                where=or_(Buildid.version.is_distinct_from(exc.version),
+                          Buildid.unique.is_distinct_from(exc.unique),
+                          Buildid.unique_prod.is_distinct_from(
+                              exc.unique_prod)))
+            upserted = db.session.execute(upd).rowcount
+
+        # the buildids of a channel without buildids in data are all removed
+        q = db.session.query(Buildid)
+        q = q.filter(tuple_(Buildid.product, Buildid.channel).in_(pcs))
+        if rows:
+            keys = [(r['product'], r['channel'], r['buildid']) for r in rows]
+            q = q.filter(tuple_(Buildid.product, Buildid.channel,
+                                Buildid.buildid).notin_(keys))
+        deleted = q.delete(synchronize_session=False)
+
+        logger.info('Buildids: {} inserted or updated and {} removed.'
+                    .format(upserted, deleted))
+
         if commit:
             db.session.commit()
 
@@ -164,8 +194,79 @@ class GlobalRatio(db.Model):
             db.session.commit()
 
 
+class Facets(db.Model):
+    __tablename__ = 'facets'
+
+    product = db.Column(PRODUCT_TYPE, primary_key=True)
+    channel = db.Column(CHANNEL_TYPE, primary_key=True)
+    buildid = db.Column(db.DateTime(timezone=True), primary_key=True)
+    numbers = db.Column(pg.JSONB)
+    fetched = db.Column(db.DateTime(timezone=True))
+
+    def __init__(self, product, channel, buildid, numbers, fetched):
+        self.product = product
+        self.channel = channel
+        self.buildid = buildid
+        self.numbers = numbers
+        self.fetched = fetched
+
+    @staticmethod
+    def get():
+        """Get the facets snapshots.
+
+           Returns:
+               dict: product => channel => {datetime(buildid): (fetched,
+                                            {signature: [raw, installs]})}
+        """
+        res = defaultdict(lambda: defaultdict(lambda: dict()))
+        for q in db.session.query(Facets):
+            buildid = q.buildid.astimezone(pytz.utc)
+            res[q.product][q.channel][buildid] = (q.fetched, q.numbers)
+        return res
+
+    @staticmethod
+    def put_data(data, bids, commit=True):
+        """Store the snapshots for the buildids in bids and remove the others.
+           A snapshot is only updated when it has been fetched again."""
+        for prod, i in bids.items():
+            data_prod = data.get(prod, {})
+            for chan, j in i.items():
+                data_pc = data_prod.get(chan, {})
+                buildids = [b[0] for b in j]
+                for bid in buildids:
+                    if bid not in data_pc:
+                        continue
+                    fetched, numbers = data_pc[bid]
+                    ins = pg.insert(Facets).values(product=prod,
+                                                   channel=chan,
+                                                   buildid=bid,
+                                                   numbers=numbers,
+                                                   fetched=fetched)
+                    upd = ins.on_conflict_do_update(
+                        index_elements=['product', 'channel', 'buildid'],
+                        set_=dict(numbers=numbers, fetched=fetched),
+                        where=Facets.fetched < fetched)
+                    db.session.execute(upd)
+
+                q = db.session.query(Facets)
+                q = q.filter(Facets.product == prod,
+                             Facets.channel == chan,
+                             Facets.buildid.notin_(buildids))
+                q.delete(synchronize_session=False)
+        if commit:
+            db.session.commit()
+
+
 class Signatures(db.Model):
     __tablename__ = 'signatures'
+    __table_args__ = (db.Index('signatures_unicity', 'product', 'channel',
+                               'signature', 'bugid', 'pushdate',
+                               unique=True),
+                      db.Index('signatures_bugid', 'bugid'),
+                      db.Index('signatures_pc_pushdate', 'product', 'channel',
+                               'pushdate', 'success'))
+    UNICITY = ['product', 'channel', 'signature', 'bugid', 'pushdate']
+    BATCH_SIZE = 1000
 
     id = db.Column(db.Integer, primary_key=True, autoincrement=True)
     product = db.Column(PRODUCT_TYPE)
@@ -202,53 +303,103 @@ class Signatures(db.Model):
 
     @staticmethod
     def get_pushdates():
+        """Get signature => bugid (as a string) => channel => pushdate.
+
+           Only the needed columns are fetched and the rows are streamed
+           from the server by batches.
+        """
         res = defaultdict(lambda: defaultdict(lambda: dict()))
-        qs = db.session.query(Signatures)
-        for q in qs:
-            res[q.signature][q.bugid][q.channel] = q.pushdate
+        qs = db.session.query(Signatures.signature,
+                              Signatures.bugid,
+                              Signatures.channel,
+                              Signatures.pushdate)
+        qs = qs.yield_per(Signatures.BATCH_SIZE)
+        for sgn, bugid, chan, pushdate in qs:
+            res[sgn][str(bugid)][chan] = pushdate
         return res
 
+    @staticmethod
+    def get_rows(data):
+        rows = {}
+        for product, i in data.items():
+            for chan, j in i.items():
+                numbers = j['numbers']
+                raw = numbers.raw.tolist()
+                installs = numbers.installs.tolist()
+                for sgn, bugid, pushdate, success in j['patches']:
+                    bugid = int(bugid)
+                    row = numbers.index[sgn]
+                    key = (product, chan, sgn, bugid, pushdate)
+                    rows[key] = {'product': product,
+                                 'channel': chan,
+                                 'signature': sgn,
+                                 'bugid': bugid,
+                                 'raw': raw[row],
+                                 'installs': installs[row],
+                                 'pushdate': pushdate,
+                                 'success': success}
+        return list(rows.values())
+
     @staticmethod
     def put_data(data, bids, ratios):
+        """Upsert the signatures data in batches.
+
+           Rows are inserted with INSERT ... ON CONFLICT on the unicity index
+           and existing rows are only updated when one of raw, installs or
+           success changed.
+
+           Returns:
+               dict: numbers of inserted, updated and unchanged rows
+        """
         logger.info('Put signatures in db: started.')
         GlobalRatio.put_data(ratios, commit=False)
-        Buildid.add_buildids(bids, commit=True)
+        Buildid.add_buildids(bids, commit=False)
+
+        rows = Signatures.get_rows(data)
+        stats = {'inserted': 0, 'updated': 0, 'unchanged': 0}
+        N = Signatures.BATCH_SIZE
+        for i in range(0, len(rows), N):
+            batch = rows[i:i + N]
+            ins = pg.insert(Signatures).values(batch)
+            exc = ins.excluded
+            upd = ins.on_conflict_do_update(
+                index_elements=Signatures.UNICITY,
+                set_=dict(raw=exc.raw,
+                          installs=exc.installs,
+                          success=exc.success),
+                where=or_(Signatures.raw.is_distinct_from(exc.raw),
+                          Signatures.installs.is_distinct_from(exc.installs),
+                          Signatures.success.is_distinct_from(exc.success)))
+            # xmax is 0 for a freshly inserted tuple
+            upd = upd.returning(literal_column('xmax = 0'))
+            changed = db.session.execute(upd).fetchall()
+            inserted = sum(1 for r in changed if r[0])
+            stats['inserted'] += inserted
+            stats['updated'] += len(changed) - inserted
+            stats['unchanged'] += len(batch) - len(changed)
+        db.session.commit()
 
-        for product, i in data.items():
-            for chan, j in i.items():
-                for sgn, infos in j.items():
-                    for info in infos:
-                        bugid = info['bugid']
-                        numbers = info['numbers']
-                        pushdate = info['pushdate']
-                        success = info['success']
-                        raw, installs = utils.get_raw_installs(numbers)
-                        s = db.session.query(Signatures)
-                        s = s.filter_by(product=product,
-                                        channel=chan,
-                                        signature=sgn,
-                                        bugid=bugid,
-                                        pushdate=pushdate).first()
-                        if s:
-                            added = False
-                            if s.raw != raw:
-                                s.raw = raw
-                                added = True
-                            if s.installs != installs:
-                                s.installs = installs
-                                added = True
-                            if s.success != success:
-                                s.success = success
-                                added = True
-                            if added:
-                                db.session.add(s)
-                        else:
-                            s = Signatures(product, chan, sgn, bugid, raw,
-                                           installs, pushdate, success)
-                            db.session.add(s)
-                    db.session.commit()
-
-        logger.info('Put signatures in db: finished.')
+        logger.info('Put signatures in db: finished ({} inserted, {} updated '
+                    'and {} unchanged).'.format(stats['inserted'],
+                                                stats['updated'],
+                                                stats['unchanged']))
+
+        return stats
+
+    @staticmethod
+    def query_bypc(product, channel, filt, min_date, max_date):
+        # uses the index signatures_pc_pushdate
+        query = db.session.query(Signatures)
+        if filt == 'all':
+            return query.filter(Signatures.product == product,
+                                Signatures.channel == channel,
+                                Signatures.pushdate <= max_date,
+                                Signatures.pushdate >= min_date)
+        return query.filter(Signatures.product == product,
+                            Signatures.channel == channel,
+                            Signatures.pushdate <= max_date,
+                            Signatures.pushdate >= min_date,
+                            Signatures.success.is_(filt == 'successful'))
 
     @staticmethod
     def get_bypc(product, channel, filt):
@@ -258,18 +409,8 @@ class Signatures(db.Model):
         max_date = vs[-1]
         min_date = vs[0]
 
-        query = db.session.query(Signatures)
-        if filt == 'all':
-            sgns = query.filter(Signatures.product == product,
-                                Signatures.channel == channel,
-                                Signatures.pushdate <= max_date,
-                                Signatures.pushdate >= min_date)
-        else:
-            sgns = query.filter(Signatures.product == product,
-                                Signatures.channel == channel,
-                                Signatures.pushdate <= max_date,
-                                Signatures.pushdate >= min_date,
-                                Signatures.success.is_(filt == 'successful'))
+        sgns = Signatures.query_bypc(product, channel, filt,
+                                     min_date, max_date)
 
         d = {}
         res = {'signatures': d,
@@ -285,17 +426,29 @@ class Signatures(db.Model):
         return res
 
     @staticmethod
-    def get_bybugid(bugid):
+    def query_bybugid(bugid):
+        # uses the index signatures_bugid
         q = db.session.query(Signatures.product, Signatures.channel,
                              Signatures.signature, Signatures.raw,
                              Signatures.installs, Signatures.pushdate,
                              Signatures.success)
-        sgns = q.filter_by(bugid=bugid)
+        return q.filter_by(bugid=bugid)
+
+    @staticmethod
+    def get_bybugid(bugid):
+        sgns = Signatures.query_bybugid(bugid).all()
 
         data = {}
         versions = {}
         res = {'data': data,
                'versions': versions}
+        if not sgns:
+            return res
+
+        # get all the versions we need in one query
+        products = list(set(sgn.product for sgn in sgns))
+        channels = list(set(sgn.channel for sgn in sgns))
+        all_versions = Buildid.get_versions(products, channels)
         cache = {}
 
         for sgn in sgns:
@@ -306,7 +459,7 @@ class Signatures(db.Model):
                 res[prod][chan] = {}
             t = (prod, chan)
             if t not in versions:
-                v = Buildid.get_versions(*t)[prod][chan]
+                v = all_versions[prod][chan]
                 d = sorted(v.keys())
                 cache[t] = d
                 versions[t] = v
@@ -325,12 +478,318 @@ class Signatures(db.Model):
         return res
 
 
+class Sumup(db.Model):
+    """The data for sumup.html of the bugs the addon asked for.
+
+       The inputs (hg urls and signatures) sent by the addon are stored with
+       their cache key and the data are computed from them during the update.
+    """
+    __tablename__ = 'sumup'
+    BATCH_SIZE = 1000
+
+    bugid = db.Column(db.Integer, primary_key=True)
+    key = db.Column(db.String(40))
+    hgurls = db.Column(db.PickleType)
+    signatures = db.Column(db.PickleType)
+    value = db.Column(db.PickleType)
+    added = db.Column(db.DateTime(timezone=True))
+    updated = db.Column(db.DateTime(timezone=True))
+
+    def __init__(self, bugid, key, hgurls, signatures, value, added, updated):
+        self.bugid = bugid
+        self.key = key
+        self.hgurls = hgurls
+        self.signatures = signatures
+        self.value = value
+        self.added = added
+        self.updated = updated
+
+    @staticmethod
+    def get(bugs):
+        """Get the precomputed data for sumup.html in one query (the bugs
+           which aren't in the table or whose data have been computed from
+           other inputs are missing).
+
+           Args:
+               bugs (dict): bugid => key
+           Returns:
+               dict: bugid => value
+        """
+        if not bugs:
+            return {}
+
+        bugids = {int(bugid): bugid for bugid in bugs.keys()}
+        q = db.session.query(Sumup.bugid, Sumup.key, Sumup.value)
+        q = q.filter(Sumup.bugid.in_(list(bugids.keys())),
+                     Sumup.value.isnot(None))
+        res = {}
+        for r in q:
+            bugid = bugids[r.bugid]
+            if r.key == bugs[bugid]:
+                res[bugid] = r.value
+        return res
+
+    @staticmethod
+    def add(bugs, commit=True):
+        """Add the inputs for the bugs, their data will be computed during
+           the next update (the data computed for other inputs are removed)
+
+           Only the bugs found in Bugzilla by the updates (the ones in
+           patchinfo) are added and the table has at most sumup_max_rows
+           rows, so the requests can't make the updates grow without bound.
+
+           Args:
+               bugs (dict): bugid => (key, hgurls, signatures)
+        """
+        if not bugs:
+            return
+
+        bugids = [int(bugid) for bugid in bugs.keys()]
+        q = db.session.query(PatchInfo.bugid)
+        known = {r.bugid for r in q.filter(PatchInfo.bugid.in_(bugids))}
+        q = db.session.query(Sumup.bugid)
+        present = {r.bugid for r in q.filter(Sumup.bugid.in_(bugids))}
+        free = config.get_sumup_max_rows() - db.session.query(Sumup).count()
+        added = {}
+        for bugid, inputs in bugs.items():
+            bugid = int(bugid)
+            if bugid not in known:
+                continue
+            if bugid not in present:
+                if free <= 0:
+                    continue
+                free -= 1
+            added[bugid] = inputs
+        if not added:
+            return
+
+        now = pytz.utc.localize(datetime.utcnow())
+        ins = pg.insert(Sumup).values([{'bugid': bugid,
+                                        'key': key,
+                                        'hgurls': list(hgurls),
+                                        'signatures': list(signatures),
+                                        'added': now}
+                                       for bugid, (key, hgurls, signatures)
+                                       in added.items()])
+        exc = ins.excluded
+        upd = ins.on_conflict_do_update(
+            index_elements=['bugid'],
+            set_=dict(key=exc.key,
+                      hgurls=exc.hgurls,
+                      signatures=exc.signatures,
+                      added=exc.added,
+                      value=None),
+            where=Sumup.key.is_distinct_from(exc.key))
+        db.session.execute(upd)
+        if commit:
+            db.session.commit()
+
+    @staticmethod
+    def get_inputs():
+        """Get bugid => (key, hgurls, signatures) for the bugs added during
+           the last days_limit days"""
+        now = pytz.utc.localize(datetime.utcnow())
+        old = now - timedelta(days=config.get_limit())
+        q = db.session.query(Sumup.bugid, Sumup.key,
+                             Sumup.hgurls, Sumup.signatures)
+        q = q.filter(Sumup.added >= old)
+        return {r.bugid: (r.key, r.hgurls, r.signatures) for r in q}
+
+    @staticmethod
+    def put_data(data, updated, commit=True):
+        """Store the data computed for the bugs and remove the ones which
+           haven't been added for days_limit days.
+
+           Args:
+               data (dict): bugid => (key, value for sumup.html)
+               updated (datetime): the date of the update
+        """
+        logger.info('Put sumup data for {} bugs in db: started.'
+                    .format(len(data)))
+        items = [(int(bugid), key, value)
+                 for bugid, (key, value) in data.items()]
+        N = Sumup.BATCH_SIZE
+        for i in range(0, len(items), N):
+            batch = items[i:i + N]
+            values = {bugid: literal(value, type_=Sumup.value.type)
+                      for bugid, _, value in batch}
+            # the inputs may have changed during the update
+            keys = [(bugid, key) for bugid, key, _ in batch]
+            q = db.session.query(Sumup)
+            q = q.filter(tuple_(Sumup.bugid, Sumup.key).in_(keys))
+            q.update({'value': case(values, value=Sumup.bugid),
+                      'updated': updated},
+                     synchronize_session=False)
+
+        old = updated - timedelta(days=config.get_limit())
+        q = db.session.query(Sumup).filter(Sumup.added < old)
+        q.delete(synchronize_session=False)
+        if commit:
+            db.session.commit()
+        logger.info('Put sumup data in db: finished.')
+
+
+class HgRevision(db.Model):
+    __tablename__ = 'hgrevision'
+
+    repo = db.Column(db.String(32), primary_key=True)
+    node = db.Column(db.String(40), primary_key=True)
+    pushdate = db.Column(db.DateTime(timezone=True))
+    backedout = db.Column(db.Boolean)
+    fetched = db.Column(db.DateTime(timezone=True))
+
+    def __init__(self, repo, node, pushdate, backedout, fetched):
+        self.repo = repo
+        self.node = node
+        self.pushdate = pushdate
+        self.backedout = backedout
+        self.fetched = fetched
+
+    @staticmethod
+    def get(keys):
+        """Get the known revisions in one query.
+
+           A revision fetched less than a day after its push can still be
+           backed out, so it's only valid during revision_ttl seconds.
+
+           Args:
+               keys (list): the (repo, node)
+           Returns:
+               dict: (repo, node) => (pushdate, backedout)
+        """
+        if not keys:
+            return {}
+
+        now = pytz.utc.localize(datetime.utcnow())
+        ttl = now - timedelta(seconds=config.get_revision_ttl())
+        settled = HgRevision.fetched - HgRevision.pushdate >= timedelta(days=1)
+        q = db.session.query(HgRevision)
+        q = q.filter(tuple_(HgRevision.repo, HgRevision.node).in_(keys),
+                     or_(settled, HgRevision.fetched >= ttl))
+        return {(r.repo, r.node): (r.pushdate.astimezone(pytz.utc),
+                                   r.backedout) for r in q}
+
+    @staticmethod
+    def put_data(data, commit=True):
+        """Store the revisions.
+
+           Args:
+               data (dict): (repo, node) => (pushdate, backedout)
+        """
+        if not data:
+            return
+
+        now = pytz.utc.localize(datetime.utcnow())
+        rows = [{'repo': repo,
+                 'node': node,
+                 'pushdate': pushdate,
+                 'backedout': backedout,
+                 'fetched': now}
+                for (repo, node), (pushdate, backedout) in data.items()]
+        ins = pg.insert(HgRevision).values(rows)
+        exc = ins.excluded
+        upd = ins.on_conflict_do_update(index_elements=['repo', 'node'],
+                                        set_=dict(pushdate=exc.pushdate,
+                                                  backedout=exc.backedout,
+                                                  fetched=exc.fetched))
+        db.session.execute(upd)
+        if commit:
+            db.session.commit()
+
+
+class PatchInfo(db.Model):
+    __tablename__ = 'patchinfo'
+    BATCH_SIZE = 1000
+
+    bugid = db.Column(db.Integer, primary_key=True)
+    last_change_time = db.Column(db.DateTime(timezone=True))
+    land = db.Column(db.PickleType)
+
+    def __init__(self, bugid, last_change_time, land):
+        self.bugid = bugid
+        self.last_change_time = last_change_time
+        self.land = land
+
+    @staticmethod
+    def get():
+        """Get the landing info of the analyzed bugs.
+
+           Returns:
+               dict: bugid (as a string) => (last_change_time,
+                                             channel => pushdate)
+        """
+        qs = db.session.query(PatchInfo).yield_per(PatchInfo.BATCH_SIZE)
+        return {str(q.bugid): (q.last_change_time.astimezone(pytz.utc), q.land)
+                for q in qs}
+
+    @staticmethod
+    def put_data(data, commit=True):
+        """Store the landing info of the bugs which changed and remove the
+           bugs which haven't changed since days_limit days.
+
+           Args:
+               data (dict): bugid => (last_change_time, channel => pushdate)
+        """
+        rows = [{'bugid': int(bugid),
+                 'last_change_time': last_change,
+                 'land': land} for bugid, (last_change, land) in data.items()]
+        N = PatchInfo.BATCH_SIZE
+        upserted = 0
+        for i in range(0, len(rows), N):
+            ins = pg.insert(PatchInfo).values(rows[i:i + N])
+            exc = ins.excluded
+            changed = PatchInfo.last_change_time.is_distinct_from(
+                exc.last_change_time)
+            upd = ins.on_conflict_do_update(
+                index_elements=['bugid'],
+                set_=dict(last_change_time=exc.last_change_time,
+                          land=exc.land),
+                where=changed)
+            upserted += db.session.execute(upd).rowcount
+
+        now = pytz.utc.localize(datetime.utcnow())
+        old = now - timedelta(days=config.get_limit())
+        q = db.session.query(PatchInfo)
+        q = q.filter(PatchInfo.last_change_time < old)
+        deleted = q.delete(synchronize_session=False)
+
+        logger.info('Patch info: {} inserted or updated and {} removed.'
+                    .format(upserted, deleted))
+
+        if commit:
+            db.session.commit()
+
+
 def clear():
     db.drop_all()
     db.session.commit()
 
 
+def remove_duplicates(engine):
+    """Remove the duplicated signatures (the most recent row is kept)
+       before creating the unicity index"""
+    on = ' AND '.join('a.{0} = b.{0}'.format(c) for c in Signatures.UNICITY)
+    query = ('DELETE FROM signatures a USING signatures b '
+             'WHERE a.id < b.id AND ' + on)
+    with engine.begin() as conn:
+        deleted = conn.execute(db.text(query)).rowcount
+    logger.info('{} duplicated signatures removed.'.format(deleted))
+
+
+def migrate(engine):
+    """Add the tables and the indexes which came after the first schema"""
+    db.create_all()
+    indexes = {i['name'] for i in inspect(engine).get_indexes('signatures')}
+    for index in Signatures.__table__.indexes:
+        if index.name not in indexes:
+            if index.unique:
+                remove_duplicates(engine)
+            index.create(bind=engine)
+
+
 def create():
     engine = db.get_engine(app)
     if not engine.dialect.has_table(engine, 'buildid'):
         db.create_all()
+    else:
+        migrate(engine)
@@ -2,14 +2,30 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this file,
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
 from libmozdata.bugzilla import Bugzilla
+from libmozdata.connection import Connection
 from libmozdata.patchanalysis import get_patch_info
-from . import utils
+from libmozdata import utils as lmdutils
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ReadTimeoutError
+from urllib3.util.retry import Retry
+from . import config, utils
 from .logger import logger
 
 
+# a shard whose search times out is bisected rather than waited for
+TIMEOUT = 60
+# the retries on the server errors (the read timeouts aren't retried)
+MAX_RETRIES = 3
+# a shard smaller than that isn't bisected anymore
+MIN_SHARD = timedelta(hours=1)
+
+
 def get_bz_params(start_date, end_date):
-    fields = ['id', 'cf_crash_signature']
+    fields = ['id', 'cf_crash_signature', 'last_change_time']
     regexp = 'http[s]?://hg\.mozilla\.org/(releases/)?mozilla-[^/]+/rev/[0-9a-f]+' # NOQA
     params = {'include_fields': fields,
               'f1': 'cf_crash_signature',
@@ -27,24 +43,105 @@ def get_bz_params(start_date, end_date):
     return params
 
 
-def get_bugs(start_date, end_date):
-    logger.info('Get bugs from {} to {}: started.'.format(start_date,
-                                                          end_date))
+def get_shards(start_date, end_date, days):
+    """Split the dates in ranges of at most days days"""
+    step = timedelta(days=days)
+    shards = []
+    while start_date < end_date:
+        shard_end = min(start_date + step, end_date)
+        shards.append((start_date, shard_end))
+        start_date = shard_end
+    return shards
+
+
+class ShardBugzilla(Bugzilla):
+    """A Bugzilla which doesn't retry the searches which time out.
+
+       The retries of Connection are set on the class and are used for the
+       read timeouts too, so the adapter is replaced with one which only
+       retries a few times on the server errors.
+    """
 
-    # the search query can be long to evaluate
-    TIMEOUT = 240
+    def __init__(self, *args, **kwargs):
+        super(ShardBugzilla, self).__init__(*args, **kwargs)
+        retries = Retry(total=MAX_RETRIES,
+                        read=0,
+                        backoff_factor=1,
+                        status_forcelist=Bugzilla.STATUS_FORCELIST)
+        self.session.mount(Bugzilla.URL, HTTPAdapter(max_retries=retries))
 
+
+def is_timeout(e):
+    """Check if the exception comes from a read timeout: through the retry
+       adapter, it's a ConnectionError wrapping a MaxRetryError whose reason
+       is a ReadTimeoutError."""
+    if isinstance(e, requests.exceptions.Timeout):
+        return True
+    reason = getattr(e.args[0], 'reason', None) if e.args else None
+    return isinstance(reason, ReadTimeoutError)
+
+
+def get_bugs_in_shard(start_date, end_date):
+    """Get the bugs in the date range: when the search times out the range
+       is bisected and each half is searched again.
+
+       Returns:
+           tuple: bugid => signatures and bugid => last_change_time
+    """
     def bug_handler(bug, data):
         if 'cf_crash_signature' in bug:
             sgns = bug['cf_crash_signature']
             sgns = utils.get_signatures([sgns])
             data[str(bug['id'])] = sgns
+            last_change = lmdutils.get_date_ymd(bug['last_change_time'])
+            changes[str(bug['id'])] = last_change
 
     bugs = {}
-    Bugzilla(get_bz_params(start_date, end_date),
-             bughandler=bug_handler,
-             bugdata=bugs,
-             timeout=TIMEOUT).get_data().wait()
+    changes = {}
+    try:
+        ShardBugzilla(get_bz_params(start_date, end_date),
+                      bughandler=bug_handler,
+                      bugdata=bugs,
+                      timeout=TIMEOUT).get_data().wait()
+    except (requests.exceptions.Timeout,
+            requests.exceptions.ConnectionError) as e:
+        if not is_timeout(e) or end_date - start_date <= MIN_SHARD:
+            raise
+        middle = start_date + (end_date - start_date) / 2
+        logger.info('Get bugs from {} to {}: timed out, bisect at {}.'
+                    .format(start_date, end_date, middle))
+        bugs, changes = get_bugs_in_shard(start_date, middle)
+        bugs2, changes2 = get_bugs_in_shard(middle, end_date)
+        bugs.update(bugs2)
+        changes.update(changes2)
+
+    return bugs, changes
+
+
+def get_bugs(start_date, end_date):
+    """Get the bugs with a landing comment changed between the two dates.
+
+       The search is split in date shards which are run concurrently.
+
+       Returns:
+           tuple: signature => [bugid] and bugid => last_change_time
+    """
+    logger.info('Get bugs from {} to {}: started.'.format(start_date,
+                                                          end_date))
+
+    shards = get_shards(start_date, end_date, config.get_bugzilla_shard_days())
+    bugs = {}
+    changes = {}
+    if shards:
+        workers = min(len(shards), config.get_bugzilla_workers())
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = [executor.submit(get_bugs_in_shard, s, e)
+                       for s, e in shards]
+            # a bug can be in several shards
+            for future in futures:
+                b, c = future.result()
+                bugs.update(b)
+                changes.update(c)
 
     res = {}
     for bugid, sgns in bugs.items():
@@ -53,10 +150,10 @@ def get_bugs(start_date, end_date):
                 res[sgn] = []
             res[sgn].append(bugid)
 
-    logger.info('{} bugs and {} signatures collected.'.format(len(bugs),
-                                                              len(res)))
+    logger.info('{} bugs and {} signatures collected in {} shards.'
+                .format(len(bugs), len(res), len(shards)))
 
-    return res, list(bugs.keys())
+    return res, changes
 
 
 def filter_land(land, date_ranges):
@@ -69,14 +166,64 @@ def filter_land(land, date_ranges):
     return res
 
 
-def get(start_date, end_date, date_ranges):
-    sgns, bugs = get_bugs(start_date, end_date)
-    channels = utils.get_channels()
+def get_patch_info_chunks(bugs, channels):
+    """Analyze the bugs by chunks in parallel"""
+    res = {}
+    chunk_size = config.get_patchinfo_chunk_size()
+    chunks = list(Connection.chunks(sorted(bugs), chunk_size=chunk_size))
+    if not chunks:
+        return res
+
+    workers = min(len(chunks), config.get_max_workers())
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(get_patch_info, chunk, channels=channels)
+                   for chunk in chunks]
+        for future in futures:
+            res.update(future.result())
+    return res
 
-    logger.info('Get patch info for {} bugs: started.'.format(len(bugs)))
-    patches = get_patch_info(bugs, channels=channels)
+
+def get_landings(start_date, end_date, patchinfos=None):
+    """Get the signatures and the landing info of the bugs changed between
+       the two dates. This part doesn't depend on the buildids.
+
+       Args:
+           patchinfos (dict): bugid => (last_change_time, land), the landing
+                              info of a bug is only computed again when the
+                              bug changed. The dict is updated with the new
+                              landing info.
+    """
+    sgns, changes = get_bugs(start_date, end_date)
+    channels = utils.get_channels()
+    if patchinfos is None:
+        patchinfos = {}
+
+    patches = {}
+    tocheck = []
+    for bugid, last_change in changes.items():
+        info = patchinfos.get(bugid)
+        if info and info[0] == last_change:
+            if info[1]:
+                patches[bugid] = {'land': info[1]}
+        else:
+            tocheck.append(bugid)
+
+    logger.info('Get patch info for {} bugs ({} cached): started.'
+                .format(len(tocheck), len(changes) - len(tocheck)))
+    fresh = get_patch_info_chunks(tocheck, channels)
+    for bugid in tocheck:
+        # the bugs without landings are kept to avoid to analyze them again
+        land = fresh.get(bugid, {}).get('land')
+        patchinfos[bugid] = (changes[bugid], land)
+        if land:
+            patches[bugid] = {'land': land}
     logger.info('{} bugs have patches.'.format(len(patches)))
 
+    return sgns, patches
+
+
+def get_pushdates(sgns, patches, date_ranges):
+    """Get the pushdates in the date ranges of the buildids"""
     pushdates = {}
     for sgn, bugs in sgns.items():
         for bug in bugs:
@@ -92,3 +239,8 @@ def get(start_date, end_date, date_ranges):
     logger.info('Get patch info: finished.')
 
     return pushdates
+
+
+def get(start_date, end_date, date_ranges, patchinfos=None):
+    sgns, patches = get_landings(start_date, end_date, patchinfos=patchinfos)
+    return get_pushdates(sgns, patches, date_ranges)
@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from abc import ABC, abstractmethod
+import calendar
+from datetime import datetime
+import functools
+import msgpack
+import pickle
+import pytz
+import zlib
+from . import config
+
+
+DATETIME_EXT = 1
+
+
+class Serializer(ABC):
+    """Serialize the cached values in bytes.
+
+       The first byte is the schema version: a value with another version
+       (e.g. put in the cache by an older version of the code) is discarded
+       and the compression level can be tuned.
+    """
+
+    VERSION = 0
+
+    def __init__(self, compress_level=1):
+        self.compress_level = compress_level
+        self.header = bytes([self.VERSION])
+
+    @abstractmethod
+    def encode(self, value):
+        """Get the bytes for the value"""
+
+    @abstractmethod
+    def decode(self, data):
+        """Get the value from the bytes"""
+
+    def dumps(self, value):
+        data = self.encode(value)
+        return self.header + zlib.compress(data, self.compress_level)
+
+    def loads(self, data):
+        """Get the value (None if the data cannot be decoded)"""
+        if not isinstance(data, bytes) or data[:1] != self.header:
+            return None
+        return self.decode(zlib.decompress(data[1:]))
+
+
+class PickleSerializer(Serializer):
+
+    VERSION = 1
+
+    def encode(self, value):
+        return pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def decode(self, data):
+        return pickle.loads(data)
+
+
+def encode_ext(obj):
+    if isinstance(obj, datetime):
+        # the datetimes we've are in UTC with a second resolution
+        ts = calendar.timegm(obj.utctimetuple())
+        return msgpack.ExtType(DATETIME_EXT, msgpack.packb(ts))
+    raise TypeError('Cannot serialize {}'.format(type(obj)))
+
+
+@functools.lru_cache(maxsize=1024)
+def get_datetime(data):
+    # the same pushdates are in the data of many signatures
+    return datetime.fromtimestamp(msgpack.unpackb(data), pytz.utc)
+
+
+def decode_ext(code, data):
+    if code == DATETIME_EXT:
+        return get_datetime(data)
+    return msgpack.ExtType(code, data)
+
+
+class MsgpackSerializer(Serializer):
+    """msgpack with the datetimes as epoch ints.
+
+       The arrays are decoded as tuples (so they can be used as dict keys,
+       e.g. the (product, channel) in the versions).
+    """
+
+    VERSION = 2
+
+    def encode(self, value):
+        return msgpack.packb(value, default=encode_ext, use_bin_type=True)
+
+    def decode(self, data):
+        return msgpack.unpackb(data, ext_hook=decode_ext, use_list=False,
+                               strict_map_key=False, raw=False)
+
+
+SERIALIZERS = {'pickle': PickleSerializer,
+               'msgpack': MsgpackSerializer}
+
+
+def get_serializer(name=None, compress_level=None):
+    """Get the serializer (by default the one in global.json)"""
+    if name is None:
+        name = config.get_cache_serializer()
+    if compress_level is None:
+        compress_level = config.get_cache_compress_level()
+    return SERIALIZERS[name](compress_level=compress_level)
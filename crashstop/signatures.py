@@ -3,6 +3,7 @@
 # You can obtain one at http://mozilla.org/MPL/2.0/.
 
 from collections import defaultdict, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from libmozdata import socorro
@@ -12,74 +13,198 @@ from sqlalchemy.exc import OperationalError
 import time
 from . import datacollector as dc
 from . import buildhub, config, models, patchinfo, tools, utils
-from .const import RAW, INSTALLS, STARTUP, PLATFORMS
 from .logger import logger
 
 
-def update(date='today'):
+def update(date='today', incremental=None):
+    """Update the data in the db.
+
+       Args:
+           incremental (bool): if True, for the global ratios, only the top
+                               signatures facets of the new and the hot
+                               buildids are fetched, the other ones come from
+                               the db. The crash numbers of the patched
+                               signatures are always fetched for all the
+                               buildids (the snapshots only have the top
+                               signatures). Default value is in global.json.
+    """
     d = lmdutils.get_date(date)
     logger.info('Update data for {}: started.'.format(d))
-    data, bids, ratios, ranges, last_date = get(date=date)
+    if incremental is None:
+        incremental = config.get_incremental()
+    facets = models.Facets.get() if incremental else None
+    patchinfos = models.PatchInfo.get()
+    data, bids, ratios, ranges, last_date = get(date=date, facets=facets,
+                                                patchinfos=patchinfos)
     models.Signatures.put_data(data, bids, ratios)
+    if incremental:
+        models.Facets.put_data(facets, bids)
+    models.PatchInfo.put_data(patchinfos)
     models.Signatures.clean(ranges)
     models.Lastdate.set(last_date)
+    warm_cache(last_date)
+    precompute_sumups(last_date, date=date)
     logger.info('Update data for {}: finished.'.format(d))
 
 
-def update_patches(start_date, end_date, date_ranges):
-    last_date = models.Lastdate.get()
-    old_patches = models.Signatures.get_pushdates()
-    if last_date:
-        start_date = last_date
-        end_date = pytz.utc.localize(datetime.utcnow())
-    patches = patchinfo.get(start_date, end_date, date_ranges)
+def warm_cache(last_date):
+    from . import cache
+    try:
+        cache.warm_signatures(last_date)
+    except Exception:
+        logger.error('Cannot warm the cache', exc_info=True)
+
+
+def precompute_sumups(last_date, date='today'):
+    """Precompute the data for sumup.html: a failure here mustn't fail
+       the update (the live path is still there)"""
+    try:
+        sumups = get_sumups(models.Sumup.get_inputs(), date=date)
+        models.Sumup.put_data(sumups, last_date)
+    except Exception:
+        models.db.session.rollback()
+        logger.error('Cannot precompute the sumup data', exc_info=True)
+
+
+def update_patches(patches, old_patches):
+    """Add the patches we've in the db to the new ones.
+
+       The new pushdates win and the dicts in old_patches are reused
+       (so old_patches mustn't be used after that).
+    """
     for s, i in old_patches.items():
-        if s not in patches:
-            patches[s] = dict(i)
-        else:
-            patches_s = patches[s]
-            for b, j in i.items():
-                if b not in patches_s:
-                    patches_s[b] = j
-                else:
-                    patches_sb = patches_s[b]
-                    for c, l in j.items():
-                        if c not in patches_sb:
-                            patches_sb[c] = l
-                        else:
-                            patches_sb[c] += l
-
-    return patches, end_date
+        patches_s = patches.get(s)
+        if patches_s is None:
+            patches[s] = i
+            continue
+        for b, j in i.items():
+            patches_sb = patches_s.get(b)
+            if patches_sb is None:
+                patches_s[b] = j
+            else:
+                for c, pushdate in j.items():
+                    patches_sb.setdefault(c, pushdate)
+
+    return patches
+
+
+def timed(stages, name, f, *args, **kwargs):
+    """Call f and put the time it took in stages[name]"""
+    start = time.time()
+    try:
+        return f(*args, **kwargs)
+    finally:
+        stages[name] = time.time() - start
+
+
+def log_stages(stages):
+    report = ', '.join('{}: {}s'.format(name, round(t, 2))
+                       for name, t in stages.items())
+    logger.info('Time spent in each stage: {}.'.format(report))
+
+
+def log_timings(name, timings):
+    """Log the number of queries and the time they took in each
+       product/channel (timings are (product, channel, _, seconds))"""
+    if not timings:
+        return
+    by_pc = OrderedDict()
+    for prod, chan, _, t in sorted(timings, key=lambda x: x[:2]):
+        by_pc.setdefault((prod, chan), []).append(t)
+    report = ', '.join('{}-{}: {} queries in {}s (max {}s)'
+                       .format(prod, chan, len(ts), round(sum(ts), 2),
+                               round(max(ts), 2))
+                       for (prod, chan), ts in by_pc.items())
+    logger.info('Time spent in the {} queries: {}.'.format(name, report))
 
 
 def get(date='today',
         products=utils.get_products(),
-        channels=utils.get_channels()):
+        channels=utils.get_channels(),
+        facets=None,
+        patchinfos=None):
+    """Get the crash data for the patched signatures.
+
+       The sources are fetched in a pipeline:
+        - Buildhub and, if we already have a last date, the landings from
+          Bugzilla/hg are fetched concurrently;
+        - once we've the buildids, the global ratios are computed from
+          the top signatures in Socorro while the landings are still fetched;
+        - once we've the patched signatures, their crash numbers are
+          collected from Socorro;
+        - finally the success of the patches is computed.
+    """
     today = lmdutils.get_date_ymd(date)
     tomorrow = today + relativedelta(days=1)
     few_days_ago = today - relativedelta(days=config.get_limit())
     search_date = socorro.SuperSearch.get_search_date(few_days_ago, tomorrow)
+    stages = OrderedDict()
+    ratios_timings = []
+    numbers_timings = []
+    start = time.time()
 
-    bids = buildhub.get()
-    start_date, end_date, date_ranges = utils.get_dates(bids)
-    patches, last_date = update_patches(start_date, end_date, date_ranges)
-
-    signatures = set(patches.keys())
-    res, ratios = dc.get_sgns_by_buildid(signatures, channels,
-                                         products, search_date,
-                                         bids)
-    res = tools.compute_success(res, patches, bids, ratios)
+    last_date = models.Lastdate.get()
+    old_patches = models.Signatures.get_pushdates()
 
-    return res, bids, ratios, date_ranges, last_date
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        f_bids = executor.submit(timed, stages, 'buildhub', buildhub.get)
+        f_landings = None
+        if last_date:
+            # the landings don't depend on the buildids
+            end_date = pytz.utc.localize(datetime.utcnow())
+            f_landings = executor.submit(timed, stages, 'bugzilla',
+                                         patchinfo.get_landings,
+                                         last_date, end_date,
+                                         patchinfos=patchinfos)
+
+        bids = f_bids.result()
+        start_date, bids_end_date, date_ranges = utils.get_dates(bids)
+        if f_landings is None:
+            end_date = bids_end_date
+            f_landings = executor.submit(timed, stages, 'bugzilla',
+                                         patchinfo.get_landings,
+                                         start_date, end_date,
+                                         patchinfos=patchinfos)
+
+        # the global ratios don't depend on the signatures
+        f_ratios = executor.submit(timed, stages, 'socorro-ratios',
+                                   dc.get_ratios, channels, products,
+                                   search_date, bids, facets=facets,
+                                   timings=ratios_timings)
+
+        sgns, landings = f_landings.result()
+        patches = patchinfo.get_pushdates(sgns, landings, date_ranges)
+        patches = update_patches(patches, old_patches)
+
+        # and we only get the numbers for the patched signatures
+        f_numbers = executor.submit(timed, stages, 'socorro-numbers',
+                                    dc.get_sgns_numbers, set(patches.keys()),
+                                    channels, products, search_date, bids,
+                                    timings=numbers_timings)
+
+        ratios = f_ratios.result()
+        numbers = f_numbers.result()
+
+    res = timed(stages, 'success', tools.compute_success,
+                numbers, patches, bids, ratios)
+
+    stages['total'] = time.time() - start
+    log_stages(stages)
+    log_timings('ratios', ratios_timings)
+    log_timings('numbers', numbers_timings)
+
+    return res, bids, ratios, date_ranges, end_date
 
 
 def get_corrected_data(data):
-    res = defaultdict(lambda: defaultdict(lambda: dict()))
+    """Keep only the signatures with crashes"""
+    res = defaultdict(lambda: dict())
     for p, i in data.items():
-        for c, j in i.items():
-            for sgn, numbers in j.items():
-                if not isinstance(numbers, list):
-                    res[p][c][sgn] = numbers
+        for c, numbers in i.items():
+            if numbers.seen.any():
+                seen = numbers.seen.tolist()
+                sgns = {s for s, x in zip(numbers.signatures, seen) if x}
+                res[p][c] = numbers.select(sgns)
 
     return res
 
@@ -96,76 +221,149 @@ def get_all_versions(products, channels):
     raise Exception('Not able to get all the versions from the DB')
 
 
-def get_for_urls_sgns(hg_urls, signatures, products,
-                      sumup=False, extra={}, date='today'):
+def get_versions_dates(all_versions, products, channels):
+    versions = {}
+    dates = {}
+    for product in products:
+        all_v_prod = all_versions[product]
+        for chan in channels:
+            # v is a dict: bid -> (version, unique, unique_prod)
+            v = all_v_prod[chan]
+            versions[(product, chan)] = {b: ver[0] for b, ver in v.items()}
+            dates[(product, chan)] = sorted(v.keys())
+
+    return versions, dates
+
+
+def get_sgns_info(numbers, pushdate, dates):
+    """Get the data to display for each signature in numbers"""
+    res = {}
+    raw = numbers.raw.tolist()
+    installs = numbers.installs.tolist()
+    startup = numbers.startup.tolist()
+    for row, sgn in enumerate(numbers.signatures):
+        platforms = numbers.get_platforms(row)
+        res[sgn] = {'pushdate': pushdate,
+                    'dates': dates,
+                    'raw': raw[row],
+                    'installs': installs[row],
+                    'startup': startup[row],
+                    'platforms': utils.percentage_platforms(platforms)}
+
+    return res
+
+
+def get_bug_data(sgns_data, signatures, pushdates, dates):
+    """Get the data for the signatures of a bug from the numbers collected
+       for several bugs"""
     data = {}
-    res = {'data': data,
-           'versions': {}}
+    for product, i in sgns_data.items():
+        for chan, j in i.items():
+            numbers = j.select(signatures)
+            if len(numbers):
+                if product not in data:
+                    data[product] = {}
+                data[product][chan] = get_sgns_info(numbers,
+                                                    pushdates.get(chan),
+                                                    dates[(product, chan)])
+    return data
 
-    if not sumup:
-        signatures = utils.get_signatures(signatures)
-    if not signatures:
-        return res
 
-    chan_rev = utils.analyze_hg_urls(hg_urls, sumup=sumup)
-    towait, pushdates = dc.get_pushdates(chan_rev)
+def get_for_chan_rev_sgns(queries, products, extra={}, date='today'):
+    """Get the data for several sets of revisions and signatures.
+
+       The revisions and the signatures are deduplicated so hg and Socorro
+       are queried only once for all of them.
+
+       Args:
+           queries (list): the (channel => [revision], signatures)
+       Returns:
+           list: the data (as in get_for_urls_sgns) for each query
+    """
+    all_chan_rev = defaultdict(lambda: set())
+    all_sgns = set()
+    for chan_rev, signatures in queries:
+        all_sgns.update(signatures)
+        for chan, revs in chan_rev.items():
+            all_chan_rev[chan].update(revs)
+
+    if not all_sgns:
+        return [{'data': {}, 'versions': {}} for _ in queries]
+
+    towait, revisions = dc.get_revisions(all_chan_rev)
 
-    res['versions'] = versions = {}
-    dates = {}
     products = utils.get_products() if not products else products
     channels = utils.get_channels()
     all_versions = get_all_versions(products, channels)
     sgns_data = dc.get_sgns_data(channels, all_versions,
-                                 signatures, extra,
+                                 all_sgns, extra,
                                  products, towait, date=date)
 
-    for product in products:
-        all_v_prod = all_versions[product]
-        for chan in channels:
-            # v is a dict: bid -> (version, unique, unique_prod)
-            v = all_v_prod[chan]
-            versions[(product, chan)] = {b: ver[0] for b, ver in v.items()}
-            dates[(product, chan)] = sorted(v.keys())
+    versions, dates = get_versions_dates(all_versions, products, channels)
 
     for tw in towait:
         tw.wait()
 
     sgns_data = get_corrected_data(sgns_data)
 
-    for chan, pds in pushdates.items():
-        if pds:
-            pushdates[chan] = max(pds)
+    res = []
+    for chan_rev, signatures in queries:
+        data = {}
+        if signatures:
+            pushdates = dc.get_channel_pushdates(chan_rev, revisions)
+            for chan, pds in pushdates.items():
+                pushdates[chan] = max(pds) if pds else None
+            data = get_bug_data(sgns_data, set(signatures), pushdates, dates)
+        res.append({'data': data,
+                    'versions': versions if signatures else {}})
+
+    return res
 
-    for product, i in sgns_data.items():
-        data[product] = d1 = {}
-        for chan, j in i.items():
-            d1[chan] = d2 = {}
-            pushdate = pushdates.get(chan)
-            ds = dates[(product, chan)]
-            L = len(ds)
-            for sgn, numbers in j.items():
-                raw = [0] * L
-                installs = [0] * L
-                startup = [False] * L
-                platforms = {}
-                for k in range(L):
-                    d = ds[k]
-                    n = numbers[d]
-                    raw[k] = n[RAW]
-                    installs[k] = n[INSTALLS]
-                    startup[k] = n[STARTUP]
-                    for platf, count in n[PLATFORMS].items():
-                        if platf in platforms:
-                            platforms[platf] += count
-                        else:
-                            platforms[platf] = count
-
-                d2[sgn] = {'pushdate': pushdate,
-                           'dates': ds,
-                           'raw': raw,
-                           'installs': installs,
-                           'startup': startup,
-                           'platforms': utils.percentage_platforms(platforms)}
+
+def get_for_urls_sgns(hg_urls, signatures, products,
+                      sumup=False, extra={}, date='today'):
+    if not sumup:
+        signatures = utils.get_signatures(signatures)
+    if not signatures:
+        return {'data': {}, 'versions': {}}
+
+    chan_rev = utils.analyze_hg_urls(hg_urls, sumup=sumup)
+    return get_for_chan_rev_sgns([(chan_rev, signatures)], products,
+                                 extra=extra, date=date)[0]
+
+
+def get_for_sumups(queries, extra={}, date='today'):
+    """Get the data for sumup.html for several bugs at once.
+
+       Args:
+           queries (list): the (hg_urls, signatures) as sent by the addon
+       Returns:
+           list: the data for each query
+    """
+    queries = [(utils.analyze_hg_urls(hg_urls, sumup=True), signatures)
+               for hg_urls, signatures in queries]
+    return get_for_chan_rev_sgns(queries, [], extra=extra, date=date)
+
+
+def get_sumups(inputs, date='today'):
+    """Compute the data for sumup.html for the bugs the addon asked for.
+
+       The data are computed from the same inputs as the live path and the
+       crash numbers for all the signatures are collected at once.
+
+       Args:
+           inputs (dict): bugid => (key, hgurls, signatures)
+       Returns:
+           dict: bugid => (key, the data for sumup.html as in cache.get_value)
+    """
+    logger.info('Precompute sumup data for {} bugs: started.'
+                .format(len(inputs)))
+    bugids = list(inputs.keys())
+    queries = [inputs[b][1:] for b in bugids]
+    data = get_for_sumups(queries, date=date)
+    res = {b: (inputs[b][0], prepare_bug_for_html(d))
+           for b, d in zip(bugids, data)}
+    logger.info('Precompute sumup data: finished.')
 
     return res
 
@@ -179,22 +377,17 @@ def prepare_signatures_for_html(data, product, channel):
                                               'product': product})
     versions = data['versions']
     dates = sorted(versions.keys())
-    data['buildids'] = buildids = [utils.get_buildid(d) for d in dates]
+    data['buildids'] = [utils.get_buildid(d) for d in dates]
     data['versions'] = {utils.get_buildid(d): v for d, v in versions.items()}
-    links = {}
 
     for sgn, info in data['signatures'].items():
         sgn = utils.get_str(sgn)
         params['signature'] = utils.get_esearch_sgn(sgn)
+        # the links for the buildids are made in the template
+        # with utils.get_crash_reports_link
         url = socorro.SuperSearch.get_link(params)
-        url += '#facet-build_id'
-        info['socorro_url'] = url
-        for bid in buildids:
-            params['build_id'] = '=' + bid
-            url = socorro.SuperSearch.get_link(params)
-            url += '#crash-reports'
-            links[(sgn, bid)] = url
-        del params['build_id']
+        info['base_url'] = url
+        info['socorro_url'] = url + '#facet-build_id'
 
     for info in data['signatures'].values():
         utils.set_position(info, dates)
@@ -203,8 +396,6 @@ def prepare_signatures_for_html(data, product, channel):
                                 key=lambda p: (p[1]['bugid'], p[0]),
                                 reverse=True)
 
-    data['links'] = links
-
     return data
 
 
@@ -231,7 +422,6 @@ def get_affected(data, versions):
 def prepare_bug_for_html(data, extra={}):
     params = utils.get_params_for_link()
     has_extra = utils.update_params(params, extra)
-    links = {}
     _versions = data['versions']
     data = data['data']
     versions = {k: {utils.get_buildid(d): ver for d, ver in v.items()} for k, v in _versions.items()}
@@ -250,20 +440,14 @@ def prepare_bug_for_html(data, extra={}):
                 url = socorro.SuperSearch.get_link(params)
                 url += '#facet-build_id'
                 info['socorro_url'] = url
+                # the links for the buildids (with their version) are made
+                # in the template with utils.get_crash_reports_link
+                params['version'] = None
+                info['base_url'] = socorro.SuperSearch.get_link(params)
                 dates = info['dates']
                 del info['dates']
                 utils.set_position(info, dates)
-                info['buildids'] = bids = []
-                for d in dates:
-                    bid = utils.get_buildid(d)
-                    params['version'] = version_pc[bid]
-                    bids.append(bid)
-                    params['build_id'] = '=' + bid
-                    url = socorro.SuperSearch.get_link(params)
-                    url += '#crash-reports'
-                    links[(sgn, prod, chan, bid)] = url
-                if 'build_id' in params:
-                    del params['build_id']
+                info['buildids'] = [utils.get_buildid(d) for d in dates]
 
     # order the data
     results = OrderedDict()
@@ -274,4 +458,4 @@ def prepare_bug_for_html(data, extra={}):
                 if chan in data[prod]:
                     d[chan] = sorted(data[prod][chan].items())
 
-    return results, links, versions, affected, has_extra
+    return results, versions, affected, has_extra
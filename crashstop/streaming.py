@@ -0,0 +1,114 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import io
+import ijson
+import time
+from ijson.common import ObjectBuilder
+from libmozdata import socorro
+from .logger import logger
+
+
+STARTS = {'start_map', 'start_array', 'string', 'number', 'boolean', 'null'}
+
+
+class Length(object):
+    """Stand for a list when we only need its length"""
+
+    __slots__ = ('n',)
+
+    def __init__(self):
+        self.n = 0
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return 'Length({})'.format(self.n)
+
+
+def parse_facets(stream, field, counted=()):
+    """Parse the facets for a field in a SuperSearch response without
+       building the whole json tree.
+
+       Args:
+           stream (file): the json response
+           field (str): the facet to get (e.g. 'signature')
+           counted (list): the lists in the facet buckets we only need the
+                           length of (e.g. 'facets.install_time'), they're
+                           replaced by a Length
+       Returns:
+           dict: {'facets': {field: [bucket, ...]}}
+    """
+    item = 'facets.' + field + '.item'
+    counted = {item + '.' + c for c in counted}
+    counted_items = {c + '.item': c for c in counted}
+    deeper = tuple(c + '.item.' for c in counted)
+    buckets = []
+    builder = None
+    lengths = {}
+
+    for prefix, event, value in ijson.parse(stream, use_float=True):
+        if builder is None:
+            if prefix == item and event == 'start_map':
+                builder = ObjectBuilder()
+                builder.event(event, value)
+            continue
+
+        if prefix == item and event == 'end_map':
+            builder.event(event, value)
+            buckets.append(builder.value)
+            builder = None
+        elif prefix in counted:
+            if event == 'start_array':
+                lengths[prefix] = length = Length()
+                builder.event('number', length)
+        elif prefix in counted_items:
+            if event in STARTS:
+                lengths[counted_items[prefix]].n += 1
+        elif not prefix.startswith(deeper):
+            builder.event(event, value)
+
+    return {'facets': {field: buckets}}
+
+
+class SuperSearch(socorro.SuperSearch):
+    """A SuperSearch where the handlers get the facets parsed by parse_facets
+       instead of the whole decoded json.
+
+       The parsed json has an 'elapsed' key with the time taken by the query
+       (request, download and parsing).
+    """
+
+    def __init__(self, field, counted=(), max_workers=None, **kwargs):
+        self.field = field
+        self.counted = counted
+        if max_workers is not None:
+            # the session (and its pool of workers) is built in
+            # Connection.__init__ before the kwargs are read
+            self.MAX_WORKERS = max_workers
+        super(SuperSearch, self).__init__(**kwargs)
+
+    def _Connection__get_cb(self, query):
+        # replace the callback of libmozdata.connection.Connection
+        # which decodes the whole response
+        def cb(res, *args, **kwargs):
+            if res.status_code == 200:
+                start = time.time()
+                json = parse_facets(io.BytesIO(res.content),
+                                    self.field, self.counted)
+                # res.elapsed stops when the headers are received
+                elapsed = res.elapsed.total_seconds()
+                json['elapsed'] = elapsed + time.time() - start
+                if query.handlerdata is not None:
+                    query.handler(json, query.handlerdata)
+                else:
+                    query.handler(json)
+            elif self.RAISE_ERROR:
+                res.raise_for_status()
+            else:
+                logger.error('SuperSearch error for {}: {}'.format(res.url,
+                                                                   res.text))
+
+        return cb
@@ -5,17 +5,11 @@
 from bisect import bisect_left
 import numpy as np
 from . import config
-from .const import INSTALLS
 
 
 def get_global_ratios(data):
-    R = len(data)
-    for numbers in data.values():
-        C = len(numbers)
-        break
-    x = np.empty((R, C), dtype=np.float64)
-    for i, numbers in enumerate(data.values()):
-        x[i, :] = [n[INSTALLS] for n in numbers]
+    """Get the global ratio for the crash numbers (a CrashNumbers)"""
+    x = data.installs.astype(np.float64)
 
     meds = np.median(x, axis=1)
     notnull = meds != 0.
@@ -33,8 +27,6 @@ def get_threshold(x, min_value, ratio):
 
 
 def check_patch(numbers, pushdate, bids, ratio, min_value):
-    numbers = [n[INSTALLS] for n in numbers]
-
     # pos is the position of the first build with the patch
     pos = bisect_left(bids, pushdate)
 
@@ -71,19 +63,96 @@ def check_patch(numbers, pushdate, bids, ratio, min_value):
     return get_threshold(mean_with_patch, min_value, 3. * ratio) < in_spike
 
 
+def check_patches(installs, positions, ratio, min_value):
+    """Vectorized version of check_patch.
+
+       Args:
+           installs (numpy.ndarray): installs, one row per patch
+           positions (numpy.ndarray): position of the first build with
+                                      the patch (as in check_patch)
+       Returns:
+           numpy.ndarray: True if the patch is a success
+    """
+    x = np.asarray(installs, dtype=np.float64)
+    pos = np.asarray(positions, dtype=np.int64)
+    S, B = x.shape
+    res = np.zeros(S, dtype=bool)
+    if S == 0 or B == 0:
+        return res
+
+    # installs are integers so the sums are exact whatever the order is
+    # and the means are the same as the ones computed with np.mean
+    sums = np.zeros((S, B + 1), dtype=np.float64)
+    np.cumsum(x, axis=1, out=sums[:, 1:])
+    rows = np.arange(S)
+    total = sums[:, B]
+
+    # all the builds contain the patch
+    first = pos == 0
+    res[first] = total[first] / B < min_value
+
+    some = (pos > 0) & (pos < B)
+    mean_with_patch = np.zeros(S, dtype=np.float64)
+    with_patch = total[some] - sums[rows[some], pos[some]]
+    mean_with_patch[some] = with_patch / (B - pos[some])
+    null = some & (mean_with_patch == 0.)
+    res[null] = True
+    todo = some & ~null
+
+    # look for the first spike in the builds without the patch
+    m = x[:, 0].copy()
+    p = pos.copy()
+    active = todo.copy()
+    r = 1. + ratio
+    min_threshold = min_value * r
+    for i in range(1, B):
+        active &= i < pos
+        if not active.any():
+            break
+        threshold = np.where(m == 0., min_threshold, m * r)
+        xi = x[:, i]
+        spike = active & (xi >= threshold)
+        p[spike] = i
+        active &= ~spike
+        fi = float(i)
+        m = np.where(active, (fi * m + xi) / (fi + 1.), m)
+
+    in_spike = m
+    spike = todo & (p != pos)
+    rs, ps, qs = rows[spike], p[spike], pos[spike]
+    in_spike[spike] = (sums[rs, qs] - sums[rs, ps]) / (qs - ps)
+
+    r = 1. + 3. * ratio
+    threshold = np.where(mean_with_patch == 0., min_value * r,
+                         mean_with_patch * r)
+    res[todo] = threshold[todo] < in_spike[todo]
+
+    return res
+
+
 def compute_success(data, patches, bids, ratios):
+    """Compute the success of the patches.
+
+       Returns:
+           dict: for each product/channel, the crash numbers (a CrashNumbers)
+                 and the patches as a list of (sgn, bugid, pushdate, success)
+    """
     res = {}
     for prod, i in data.items():
         bids_prod = bids[prod]
         ratios_prod = ratios[prod]
         res[prod] = res_prod = {}
-        for chan, j in i.items():
+        for chan, numbers in i.items():
             ratio = ratios_prod[chan]
             bids_chan = [b[0] for b in bids_prod[chan]]
-            res_prod[chan] = res_chan = {}
             min_value = config.get_min(prod, chan)
-            for sgn, numbers in j.items():
-                patch = patches[sgn]
+            entries = []
+            rows = []
+            positions = []
+            for row, sgn in enumerate(numbers.signatures):
+                patch = patches.get(sgn)
+                if not patch:
+                    continue
                 for bug, k in patch.items():
                     pushdate = k.get(chan)
                     if not pushdate:
@@ -92,14 +161,16 @@ def compute_success(data, patches, bids, ratios):
                     if bids_chan[0] > pushdate:
                         continue
 
-                    success = check_patch(numbers, pushdate,
-                                          bids_chan, ratio,
-                                          min_value)
+                    entries.append((sgn, bug, pushdate))
+                    rows.append(row)
+                    positions.append(bisect_left(bids_chan, pushdate))
+
+            if not entries:
+                continue
 
-                    if sgn not in res_chan:
-                        res_chan[sgn] = []
-                    res_chan[sgn].append({'numbers': numbers,
-                                          'pushdate': pushdate,
-                                          'bugid': bug,
-                                          'success': success})
+            success = check_patches(numbers.installs[rows], positions,
+                                    ratio, min_value)
+            res_prod[chan] = {'numbers': numbers,
+                              'patches': [e + (s, ) for e, s in
+                                          zip(entries, success.tolist())]}
     return res
@@ -4,22 +4,24 @@
 
 from bisect import bisect_left
 from collections import defaultdict
-import copy
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
+import functools
 from libmozdata import utils
 import math
 import pytz
 import re
 import six
+from six.moves.urllib.parse import quote, quote_plus
 from . import config
-from .const import RAW, INSTALLS
 
 
 HG_PAT = re.compile(r'^http[s]?://hg\.mozilla\.org/(?:releases/)?mozilla-([^/]*)/rev/([0-9a-f]+)$') # NOQA
 ESR_PAT = re.compile(r'^esr[0-9]+$')
 CHANS = set(config.get_channels())
 PLATFORMS = ['Windows', 'OS X', 'Linux', 'others']
+# the live buildids are interned in both directions
+BUILDID_CACHE_SIZE = 512
 
 
 try:
@@ -49,17 +51,6 @@ def get_major(v):
     return -1
 
 
-def get_raw_installs(numbers):
-    N = len(numbers)
-    raw = [0] * N
-    installs = copy.copy(raw)
-    for i in range(N):
-        n = numbers[i]
-        raw[i] = n[RAW]
-        installs[i] = n[INSTALLS]
-    return raw, installs
-
-
 def analyze_hg_url(url):
     channel = rev = ''
     m = HG_PAT.match(url)
@@ -129,6 +120,20 @@ def get_params_for_link(query={}):
     return params
 
 
+def get_crash_reports_link(base, bid, version=None):
+    """Get the link to the crash reports for a buildid.
+
+       Args:
+           base (str): the Socorro search link without build_id
+           bid (str): the buildid
+           version (str): the version (if not already in base)
+    """
+    link = base + '&build_id=' + quote('=' + bid)
+    if version:
+        link += '&version=' + quote(version)
+    return link + '#crash-reports'
+
+
 def get_correct_product(p):
     if isinstance(p, six.string_types):
         p = p.lower()
@@ -179,31 +184,52 @@ def get_bug_number(bug):
         return 0
 
 
+@functools.lru_cache(maxsize=BUILDID_CACHE_SIZE)
+def get_build_date_from_int(bid):
+    """Get the UTC datetime for a buildid as an integer.
+
+       The results are cached so the same datetime object is shared
+       between all the numbers collected for a buildid.
+    """
+    # 20160407164938 == 2016 04 07 16 49 38
+    bid, S = divmod(bid, 100)
+    bid, M = divmod(bid, 100)
+    bid, H = divmod(bid, 100)
+    Y, md = divmod(bid, 10000)
+    m, d = divmod(md, 100)
+
+    return datetime(Y, m, d, H, M, S, tzinfo=pytz.utc)
+
+
 def get_build_date(bid):
     if isinstance(bid, six.string_types):
-        Y = int(bid[0:4])
-        m = int(bid[4:6])
-        d = int(bid[6:8])
-        H = int(bid[8:10])
-        M = int(bid[10:12])
-        S = int(bid[12:])
-    else:
-        # 20160407164938 == 2016 04 07 16 49 38
-        N = 5
-        r = [0] * N
-        for i in range(N):
-            r[i] = bid % 100
-            bid //= 100
-        Y = bid
-        S, M, H, d, m = r
-    d = datetime(Y, m, d, H, M, S)
-    dutc = pytz.utc.localize(d)
+        bid = int(bid)
+    return get_build_date_from_int(bid)
 
-    return dutc
+
+@functools.lru_cache(maxsize=BUILDID_CACHE_SIZE)
+def get_utc_buildid_as_int(date):
+    """Get the buildid as an integer for a UTC datetime"""
+    return ((((date.year * 100 + date.month) * 100 + date.day) * 100 +
+             date.hour) * 100 + date.minute) * 100 + date.second
+
+
+def get_buildid_as_int(date):
+    """Get the buildid as an integer for a datetime (naive ones are in UTC)"""
+    # the same instant in two timezones is the same key in the cache
+    offset = date.utcoffset()
+    if offset:
+        date = date.astimezone(pytz.utc)
+    return get_utc_buildid_as_int(date)
+
+
+@functools.lru_cache(maxsize=BUILDID_CACHE_SIZE)
+def get_buildid_from_int(bid):
+    return '{:014d}'.format(bid)
 
 
 def get_buildid(date):
-    return date.strftime('%Y%m%d%H%M%S')
+    return get_buildid_from_int(get_buildid_as_int(date))
 
 
 def set_position(info, dates):
@@ -241,17 +267,6 @@ def get_dates(bids):
     return start_date, end_date, date_ranges
 
 
-def get_base_list(bids):
-    base = {}
-    nbase = [0] * 2
-    for p, i in bids.items():
-        base[p] = d = {}
-        bids_prod = bids[p]
-        for c in i.keys():
-            d[c] = [copy.copy(nbase) for _ in range(len(bids_prod[c]))]
-    return base
-
-
 def equals_bids(b1, b2):
     if not b1 or not b2:
         return False
@@ -272,6 +287,27 @@ def update_params(params, extra):
     return added
 
 
+def chunk_signatures(signatures, max_size, max_length):
+    """Split the signatures in batches of at most max_size signatures
+       whose encoded signature parameters are at most max_length long.
+
+       A signature too long to be batched with others is alone in its batch.
+    """
+    batch = []
+    length = 0
+    for sgn in signatures:
+        # signature=%3Dsgn&
+        n = len(quote_plus('=' + sgn)) + 11
+        if batch and (len(batch) == max_size or length + n > max_length):
+            yield batch
+            batch = []
+            length = 0
+        batch.append(sgn)
+        length += n
+    if batch:
+        yield batch
+
+
 def startup_crash_rate(data):
     res = [0, 0]
     for d in data:
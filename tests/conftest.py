@@ -9,3 +9,22 @@ import pytest
 @pytest.fixture
 def app():
     return crashstop.app
+
+
+def pytest_addoption(parser):
+    parser.addoption('--benchmark', action='store_true', default=False,
+                     help='run the benchmarks')
+
+
+def pytest_configure(config):
+    config.addinivalue_line('markers', 'benchmark: a benchmark '
+                                       '(only run with --benchmark)')
+
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption('--benchmark'):
+        return
+    skip = pytest.mark.skip(reason='needs --benchmark to run')
+    for item in items:
+        if 'benchmark' in item.keywords:
+            item.add_marker(skip)
@@ -0,0 +1,103 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from datetime import datetime
+import json
+import pytest
+import pytz
+from unittest.mock import patch
+
+
+D1 = datetime(2018, 8, 1, 10, 0, 0, 0, pytz.utc)
+D2 = datetime(2018, 8, 2, 10, 0, 0, 0, pytz.utc)
+VERSIONS = {D2: '63.0a1', D1: '63.0a1'}
+
+
+class MyDB(object):
+
+    def __init__(self):
+        self.calls = 0
+
+    def get_bypc(self, product, channel, filt):
+        self.calls += 1
+        return {'signatures': {'foo': {'bugid': 123,
+                                       'pushdate': D1,
+                                       'raw': [1, 2],
+                                       'installs': [1, 1],
+                                       'success': True}},
+                'versions': dict(VERSIONS)}
+
+    def get_bybugid(self, bugid):
+        self.calls += 1
+        info = {'pushdate': D2,
+                'dates': [D1, D2],
+                'raw': [3, 0],
+                'installs': [2, 0],
+                'success': False}
+        return {'data': {'Firefox': {'nightly': {'foo': info}}},
+                'versions': {('Firefox', 'nightly'): dict(VERSIONS)}}
+
+
+@pytest.fixture
+def db():
+    db = MyDB()
+    with patch('crashstop.cache.get_last_date', new=lambda: D2), \
+         patch('crashstop.models.Signatures.get_bypc', new=db.get_bypc), \
+         patch('crashstop.models.Signatures.get_bybugid', new=db.get_bybugid):
+        yield db
+
+
+def test_api_signatures(app, db):
+    client = app.test_client()
+    r = client.get('/api/signatures?product=firefox&channel=nightly'
+                   '&filter=successful')
+    assert r.status_code == 200
+    assert r.mimetype == 'application/json'
+    assert json.loads(r.get_data(as_text=True)) == {
+        'product': 'Firefox',
+        'channel': 'nightly',
+        'filter': 'successful',
+        'buildids': ['20180801100000', '20180802100000'],
+        'versions': ['63.0a1', '63.0a1'],
+        'signatures': {'foo': {'bugid': 123,
+                               'pushdate': '2018-08-01T10:00:00Z',
+                               'raw': [1, 2],
+                               'installs': [1, 1],
+                               'success': True}}}
+    etag = r.headers['ETag']
+
+    r = client.get('/api/signatures?product=firefox&channel=nightly',
+                   headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert r.headers['ETag'] == etag
+    assert db.calls == 1
+
+
+def test_api_bug(app, db):
+    client = app.test_client()
+    r = client.get('/api/bug/123')
+    assert r.status_code == 200
+    assert json.loads(r.get_data(as_text=True)) == {
+        'bugid': 123,
+        'data': {'Firefox': {'nightly': {
+            'buildids': ['20180801100000', '20180802100000'],
+            'versions': ['63.0a1', '63.0a1'],
+            'signatures': {'foo': {'pushdate': '2018-08-02T10:00:00Z',
+                                   'raw': [3, 0],
+                                   'installs': [2, 0],
+                                   'success': False}}}}}}
+    etag = r.headers['ETag']
+
+    r = client.get('/api/bug/123', headers={'If-None-Match': etag})
+    assert r.status_code == 304
+    assert db.calls == 1
+
+    # a new update
+    with patch('crashstop.cache.get_last_date', new=lambda: D1):
+        r = client.get('/api/bug/123', headers={'If-None-Match': etag})
+        assert r.status_code == 200
+        assert r.headers['ETag'] != etag
+    assert db.calls == 2
+
+    assert client.get('/api/bug/foo').status_code == 404
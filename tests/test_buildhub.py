@@ -9,12 +9,14 @@ import json
 import os.path
 import pytest
 import pytz
+import time
 from unittest.mock import patch
 
 
 class MyResponse:
 
     path = 'tests/data/buildhub/buildhub.json'
+    status_code = 200
 
     def __init__(self, err):
         self.err = err
@@ -31,7 +33,7 @@ class MyResponse:
         return {}
 
     @staticmethod
-    def post(err, url, data={}):
+    def post(err, url, data={}, timeout=None):
         return MyResponse(err)
 
 
@@ -54,20 +56,38 @@ def create_buildhub_data():
     yield None
 
 
-@patch('requests.post', new=functools.partial(MyResponse.post, True))
+@patch('requests.Session.post', new=functools.partial(MyResponse.post, True))
 def test_make_request_fail():
     query = buildhub.get_query()
     x = buildhub.make_request(query, 0.01, 5, lambda x: x)
     assert x is None
 
 
-@patch('requests.post', new=functools.partial(MyResponse.post, False))
+@patch('requests.Session.post', new=functools.partial(MyResponse.post, True))
+@patch('crashstop.buildhub.MAX_RETRY_TIME', new=0.2)
+def test_make_request_max_retry_time():
+    query = buildhub.get_query()
+    start = time.time()
+    x = buildhub.make_request(query, 0.05, 1000, lambda x: x)
+    assert x is None
+    assert time.time() - start < 0.5
+
+
+def test_get_delay():
+    assert buildhub.get_delay({'Backoff': '12'}, 1, 0) == 12.
+    for attempt in range(10):
+        delay = buildhub.get_delay({'Backoff': ''}, 1, attempt)
+        M = min(2 ** attempt, buildhub.MAX_SLEEP)
+        assert M / 2. <= delay <= M
+
+
+@patch('requests.Session.post', new=functools.partial(MyResponse.post, False))
 def test_make_request(create_buildhub_data):
     d = buildhub.get_raw()
     assert d == MyResponse(False).json()
 
 
-@patch('requests.post', new=functools.partial(MyResponse.post, False))
+@patch('requests.Session.post', new=functools.partial(MyResponse.post, False))
 def test_extract(create_buildhub_data):
     data = buildhub.get_raw()
     data, buildids, buildids_per_prod = buildhub.extract(data)
@@ -81,7 +101,7 @@ def test_extract(create_buildhub_data):
     assert x['buildids_per_prod'] == data['buildids_per_prod']
 
 
-@patch('requests.post', new=functools.partial(MyResponse.post, False))
+@patch('requests.Session.post', new=functools.partial(MyResponse.post, False))
 def test_get_last_versions(create_buildhub_data):
     data = buildhub.get_raw()
     data, _, _ = buildhub.extract(data)
@@ -91,7 +111,7 @@ def test_get_last_versions(create_buildhub_data):
     assert x == data
 
 
-@patch('requests.post', new=functools.partial(MyResponse.post, False))
+@patch('requests.Session.post', new=functools.partial(MyResponse.post, False))
 def test_add_unicity(create_buildhub_data):
     data = buildhub.get_raw()
     data, buildids, buildids_per_prod = buildhub.extract(data)
@@ -101,7 +121,7 @@ def test_add_unicity(create_buildhub_data):
     assert x == data
 
 
-@patch('requests.post', new=functools.partial(MyResponse.post, False))
+@patch('requests.Session.post', new=functools.partial(MyResponse.post, False))
 @patch('crashstop.datacollector.filter_nightly_buildids', new=lambda x: x)
 def test_get(create_buildhub_data):
     data = buildhub.get(bid_as_date=False)
@@ -0,0 +1,273 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from crashstop import cache, serializers
+import pytest
+import threading
+import time
+from unittest.mock import patch
+
+
+@pytest.fixture(autouse=True)
+def local_cache():
+    with patch('crashstop.cache.get_last_date', new=lambda: 'lastdate'):
+        cache.get_local().clear()
+        yield cache.get_local()
+
+
+class MyClient:
+
+    def __init__(self):
+        self.data = {}
+        self.lock = threading.Lock()
+
+    def add(self, key, value, time=0):
+        with self.lock:
+            if key in self.data:
+                return False
+            self.data[key] = value
+            return True
+
+    def get(self, key):
+        return self.data.get(key)
+
+    def set(self, key, value, time=0, compress_level=-1):
+        self.data[key] = value
+        return True
+
+    def delete(self, key):
+        self.data.pop(key, None)
+        return True
+
+
+class MyValue:
+
+    def __init__(self, sleep=0):
+        self.calls = 0
+        self.sleep = sleep
+
+    def __call__(self, hgurls, sgns, extra):
+        self.calls += 1
+        time.sleep(self.sleep)
+        return ('value', self.calls)
+
+
+def test_get_sumup_hit_miss():
+    client = MyClient()
+    value = MyValue()
+    with patch('crashstop.cache.get_client', new=lambda: client), \
+         patch('crashstop.cache.get_value', new=value):
+        before = cache.get_metrics()
+        assert cache.get_sumup(['nightly|abc'], ['sgn'], {}) == ('value', 1)
+        assert cache.get_sumup(['nightly|abc'], ['sgn'], {}) == ('value', 1)
+        after = cache.get_metrics()
+
+    assert value.calls == 1
+    assert after['misses'] - before['misses'] == 1
+    assert after['hits'] - before['hits'] == 1
+    assert after['local_hits'] - before['local_hits'] == 1
+    # the lease has been released
+    assert len(client.data) == 1
+
+
+def test_get_sumup_stale():
+    client = MyClient()
+    value = MyValue()
+    with patch('crashstop.cache.get_client', new=lambda: client), \
+         patch('crashstop.cache.get_value', new=value):
+        key = cache.get_sumup_key(['nightly|abc'], ['sgn'], {})
+        entry = (time.time() - 1, ('value', 0))
+        client.set(key, serializers.get_serializer().dumps(entry))
+        before = cache.get_metrics()
+        assert cache.get_sumup(['nightly|abc'], ['sgn'], {}) == ('value', 0)
+        assert cache.get_metrics()['stale'] - before['stale'] == 1
+
+        # the value is refreshed in background
+        for _ in range(100):
+            if value.calls == 1 and len(client.data) == 1:
+                break
+            time.sleep(0.01)
+        assert cache.get_sumup(['nightly|abc'], ['sgn'], {}) == ('value', 1)
+
+
+def test_get_sumup_coalesced():
+    client = MyClient()
+    value = MyValue(sleep=0.2)
+    results = []
+
+    def target():
+        results.append(cache.get_sumup(['nightly|abc'], ['sgn'], {}))
+
+    with patch('crashstop.cache.get_client', new=lambda: client), \
+         patch('crashstop.cache.get_value', new=value):
+        before = cache.get_metrics()
+        threads = [threading.Thread(target=target) for _ in range(5)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        after = cache.get_metrics()
+
+    assert value.calls == 1
+    assert results == [('value', 1)] * 5
+    assert after['misses'] - before['misses'] == 1
+    assert after['coalesced'] - before['coalesced'] == 4
+
+
+class MySumup:
+
+    def __init__(self, values):
+        # bugid => (key, value)
+        self.values = values
+        self.gets = 0
+        self.added = {}
+
+    def get(self, bugs):
+        self.gets += 1
+        res = {}
+        for bugid, key in bugs.items():
+            k, value = self.values.get(bugid, (None, None))
+            if k == key:
+                res[bugid] = value
+        return res
+
+    def add(self, bugs, commit=True):
+        self.added.update(bugs)
+
+
+def test_get_sumup_precomputed():
+    client = MyClient()
+    value = MyValue()
+    key = cache.get_sumup_key(['nightly|abc'], ['sgn'], {})
+    sumup = MySumup({1234: (key, ('precomputed', 0))})
+    with patch('crashstop.cache.get_client', new=lambda: client), \
+         patch('crashstop.cache.get_value', new=value), \
+         patch('crashstop.models.Sumup', new=sumup):
+        before = cache.get_metrics()
+        res = cache.get_sumup(['nightly|abc'], ['sgn'], {}, bugid=1234)
+        assert res == ('precomputed', 0)
+        assert cache.get_metrics()['precomputed'] - before['precomputed'] == 1
+
+        # the precomputed value is now in the cache
+        res = cache.get_sumup(['nightly|abc'], ['sgn'], {}, bugid=1234)
+        assert res == ('precomputed', 0)
+        assert sumup.gets == 1
+
+        # the live path for other inputs, a bug which isn't precomputed
+        # or with extra params
+        res = cache.get_sumup(['nightly|abc', 'beta|def'], ['sgn'], {},
+                              bugid=1234)
+        assert res == ('value', 1)
+        res = cache.get_sumup(['nightly|xyz'], ['sgn'], {}, bugid=5678)
+        assert res == ('value', 2)
+        res = cache.get_sumup(['nightly|ghi'], ['sgn'], {'os': 'Linux'},
+                              bugid=1234)
+        assert res == ('value', 3)
+        assert value.calls == 3
+
+    # the inputs are added to the ones to precompute
+    hgurls = ['nightly|abc', 'beta|def']
+    assert sumup.added == {
+        1234: (cache.get_sumup_key(hgurls, ['sgn'], {}), hgurls, ['sgn']),
+        5678: (cache.get_sumup_key(['nightly|xyz'], ['sgn'], {}),
+               ['nightly|xyz'], ['sgn'])}
+
+
+class MyValues:
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, queries, extra):
+        self.calls.append(queries)
+        return [('values', tuple(hgurls), tuple(sgns))
+                for hgurls, sgns in queries]
+
+
+def test_get_sumups():
+    client = MyClient()
+    value = MyValue()
+    values = MyValues()
+    key = cache.get_sumup_key(['nightly|ghi'], ['sgn3'], {})
+    sumup = MySumup({1234: (key, ('precomputed', 0))})
+    with patch('crashstop.cache.get_client', new=lambda: client), \
+         patch('crashstop.cache.get_value', new=value), \
+         patch('crashstop.cache.get_values', new=values), \
+         patch('crashstop.models.Sumup', new=sumup):
+        # the entries are shared with the single bug path
+        assert cache.get_sumup(['nightly|abc'], ['sgn'], {}) == ('value', 1)
+
+        before = cache.get_metrics()
+        res = cache.get_sumups([(1, ['nightly|abc'], ['sgn']),
+                                (2, ['nightly|def'], ['sgn', 'sgn2']),
+                                (1234, ['nightly|ghi'], ['sgn3']),
+                                (3, ['nightly|def'], ['sgn', 'sgn2']),
+                                (4, ['beta|xyz'], ['sgn4'])], {})
+        after = cache.get_metrics()
+
+        assert res == [('value', 1),
+                       ('values', ('nightly|def',), ('sgn', 'sgn2')),
+                       ('precomputed', 0),
+                       ('values', ('nightly|def',), ('sgn', 'sgn2')),
+                       ('values', ('beta|xyz',), ('sgn4',))]
+        # the missing values are computed at once and without duplicates
+        assert values.calls == [[(['nightly|def'], ['sgn', 'sgn2']),
+                                 (['beta|xyz'], ['sgn4'])]]
+        assert after['misses'] - before['misses'] == 2
+        assert after['hits'] - before['hits'] == 1
+        assert after['precomputed'] - before['precomputed'] == 1
+        # the precomputed values of the bugs are got in one query and the
+        # bugs which aren't precomputed are added
+        assert sumup.gets == 1
+        assert set(sumup.added.keys()) == {2, 3, 4}
+        # the leases have been released and the precomputed value is cached
+        assert len(client.data) == 4
+
+        # and the single bug path gets the values computed by the batch
+        res = cache.get_sumup(['beta|xyz'], ['sgn4'], {})
+        assert res == ('values', ('beta|xyz',), ('sgn4',))
+        assert value.calls == 1
+
+
+def test_local_cache(local_cache):
+    client = MyClient()
+    value = MyValue()
+    with patch('crashstop.cache.get_client', new=lambda: client), \
+         patch('crashstop.cache.get_value', new=value):
+        assert cache.get_sumup(['nightly|abc'], ['sgn'], {}) == ('value', 1)
+
+        # the value comes from the local cache even if memcached lost it
+        client.data.clear()
+        assert cache.get_sumup(['nightly|abc'], ['sgn'], {}) == ('value', 1)
+
+        # a new update invalidates the local cache
+        with patch('crashstop.cache.get_last_date', new=lambda: 'newdate'):
+            local_cache.next_check = 0
+            res = cache.get_sumup(['nightly|abc'], ['sgn'], {})
+            assert res == ('value', 2)
+
+    assert value.calls == 2
+
+
+def test_local_cache_lru():
+    local = cache.LocalCache(100, 30)
+    fresh = time.time() + 60
+    with patch('crashstop.cache.get_last_date', new=lambda: 'lastdate'):
+        local.check()
+        local.put('a', (fresh, 'a'), 40)
+        local.put('b', (fresh, 'b'), 40)
+        assert local.get('a') == (fresh, 'a')
+        # b is the least recently used
+        local.put('c', (fresh, 'c'), 40)
+        assert local.get('b') is None
+        assert local.get('a') == (fresh, 'a')
+        assert local.size == 80
+
+        # too big
+        local.put('d', (fresh, 'd'), 101)
+        assert local.get('d') is None
+
+        # not fresh anymore
+        local.put('e', (time.time() - 1, 'e'), 10)
+        assert local.get('e') is None
@@ -0,0 +1,396 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from crashstop import datacollector as dc, streaming
+from crashstop.crashnumbers import CrashNumbers
+from datetime import datetime, timedelta
+from dateutil.relativedelta import relativedelta
+import io
+import json
+from libmozdata.connection import Query
+import pytz
+import time
+from unittest.mock import patch
+
+
+def get_bids():
+    nightly = [(datetime(2018, 8, d, 10, 0, 0, 0, pytz.utc), '63.0a1')
+               for d in range(1, 5)]
+    beta = [(datetime(2018, 8, d, 12, 0, 0, 0, pytz.utc), '62.0b{}'.format(d))
+            for d in range(1, 4)]
+    return {'Firefox': {'nightly': nightly, 'beta': beta}}
+
+
+def get_bucket(term, k, day):
+    # sgn-k has 2 * k * (bid's day) crashes from k * (bid's day) installs
+    return {'term': term,
+            'count': k * day * 2,
+            'facets': {'install_time': [{'term': i, 'count': 2}
+                                        for i in range(k * day)],
+                       'cardinality_install_time': {'value': k * day}}}
+
+
+def get_facets(params):
+    chan = params['release_channel']
+    sgns = []
+    if '_aggs.signature.build_id' in params:
+        # the numbers for some signatures and all the buildids
+        for sgn in params['signature']:
+            sgn = sgn[1:]
+            if not sgn.startswith(chan + '-sgn-'):
+                continue
+            k = int(sgn.split('-')[-1])
+            buckets = [get_bucket(int(bid), k, int(bid[6:8]))
+                       for bid in params['build_id']]
+            sgns.append({'term': sgn,
+                         'count': sum(b['count'] for b in buckets),
+                         'facets': {'build_id': buckets}})
+    else:
+        # the top signatures for a buildid
+        day = int(params['build_id'][6:8])
+        for k in range(1, 6):
+            bucket = get_bucket('{}-sgn-{}'.format(chan, k), k, day)
+            del bucket['facets']['install_time']
+            sgns.append(bucket)
+    return {'facets': {'signature': sgns}}
+
+
+class MySuperSearch:
+
+    URL = 'https://crash-stats.mozilla.com/api/SuperSearch/'
+
+    def __init__(self, queries=None, **kwargs):
+        self.queries = queries
+        self.kwargs = kwargs
+
+    def parse(self, data):
+        # as in streaming.SuperSearch
+        start = time.time()
+        data = io.BytesIO(json.dumps(data).encode('utf-8'))
+        res = streaming.parse_facets(data, self.kwargs['field'],
+                                     self.kwargs.get('counted', ()))
+        res['elapsed'] = time.time() - start
+        return res
+
+    def wait(self):
+        for query in self.queries:
+            data = get_facets(query.params)
+            query.handler(self.parse(data), query.handlerdata)
+
+
+@patch('crashstop.streaming.SuperSearch', new=MySuperSearch)
+def test_get_sgns_by_buildid():
+    bids = get_bids()
+    signatures = {'nightly-sgn-1', 'nightly-sgn-3', 'beta-sgn-2', 'beta-sgn-7'}
+    timings = []
+    res, ratios = dc.get_sgns_by_buildid(signatures, ['nightly', 'beta'],
+                                         ['Firefox'], '>=2018-08-01', bids,
+                                         timings=timings)
+
+    assert set(res['Firefox'].keys()) == {'nightly', 'beta'}
+    nightly = res['Firefox']['nightly']
+    assert nightly.signatures == ['nightly-sgn-1', 'nightly-sgn-3']
+    assert nightly.buildids == [b[0] for b in bids['Firefox']['nightly']]
+    assert nightly.get_raw_installs('nightly-sgn-3') == ([6, 12, 18, 24],
+                                                         [3, 6, 9, 12])
+    beta = res['Firefox']['beta']
+    assert beta.signatures == ['beta-sgn-2', 'beta-sgn-7']
+    assert beta.get_raw_installs('beta-sgn-2') == ([4, 8, 12], [2, 4, 6])
+    # not in the top signatures
+    assert beta.get_raw_installs('beta-sgn-7') == ([14, 28, 42], [7, 14, 21])
+    assert set(ratios['Firefox'].keys()) == {'nightly', 'beta'}
+    # 7 queries for the ratios (one by buildid)
+    assert len(timings) == 7
+    assert {(p, c) for p, c, _, _ in timings} == {('Firefox', 'nightly'),
+                                                  ('Firefox', 'beta')}
+    # the time taken by each query
+    assert all(0 <= t < 1 for _, _, _, t in timings)
+
+
+class MyBatchSuperSearch(MySuperSearch):
+
+    log = []
+
+    def wait(self):
+        for query in self.queries:
+            MyBatchSuperSearch.log.append(query.params)
+            data = get_facets(query.params)
+            if '_aggs.signature.build_id' in query.params:
+                # a signature we didn't ask for (e.g. normalized by Socorro)
+                sgn = dict(data['facets']['signature'][0], term='unknown')
+                data['facets']['signature'].append(sgn)
+            query.handler(self.parse(data), query.handlerdata)
+
+
+@patch('crashstop.streaming.SuperSearch', new=MyBatchSuperSearch)
+@patch('crashstop.config.get_max_url_length', new=lambda: 60)
+def test_get_sgns_numbers_batches():
+    bids = get_bids()
+    signatures = {'nightly-sgn-{}'.format(k) for k in range(1, 6)}
+    MyBatchSuperSearch.log = []
+    timings = []
+    res = dc.get_sgns_numbers(signatures, ['nightly'], ['Firefox'],
+                              '>=2018-08-01', bids, timings=timings)
+
+    # 22 chars by encoded signature so 2 signatures by query
+    assert [len(p['signature']) for p in MyBatchSuperSearch.log] == [2, 2, 1]
+    # the time taken by each query
+    assert sorted(t[:3] for t in timings) == [('Firefox', 'nightly', 1),
+                                              ('Firefox', 'nightly', 2),
+                                              ('Firefox', 'nightly', 2)]
+    assert all(0 <= t[3] < 1 for t in timings)
+    nightly = res['Firefox']['nightly']
+    assert nightly.signatures == sorted(signatures)
+    assert nightly.get_raw_installs('nightly-sgn-5') == ([10, 20, 30, 40],
+                                                         [5, 10, 15, 20])
+
+
+def test_streaming_max_workers():
+    ss = streaming.SuperSearch(field='signature', queries=[], max_workers=3)
+    assert ss.session.executor._max_workers == 3
+    ss = streaming.SuperSearch(field='signature', queries=[])
+    max_workers = streaming.SuperSearch.MAX_WORKERS
+    assert ss.session.executor._max_workers == max_workers
+
+
+@patch('crashstop.streaming.SuperSearch', new=MySuperSearch)
+@patch('crashstop.config.get_hot_buildids', new=lambda: 1)
+def test_get_sgns_by_buildid_incremental():
+    bids = get_bids()
+    signatures = {'nightly-sgn-1', 'nightly-sgn-3', 'beta-sgn-2'}
+    channels = ['nightly', 'beta']
+    expected, expected_ratios = dc.get_sgns_by_buildid(signatures, channels,
+                                                       ['Firefox'],
+                                                       '>=2018-08-01', bids)
+    expected = get_numbers(expected)
+
+    facets = {}
+    timings = []
+    res, ratios = dc.get_sgns_by_buildid(signatures, channels, ['Firefox'],
+                                         '>=2018-08-01', bids,
+                                         timings=timings, facets=facets)
+    assert get_numbers(res) == expected
+    assert ratios == expected_ratios
+    assert len(timings) == 7
+    assert len(facets['Firefox']['nightly']) == 4
+    assert len(facets['Firefox']['beta']) == 3
+
+    # only the last buildid (the hot one) of each channel is fetched again
+    timings = []
+    res, ratios = dc.get_sgns_by_buildid(signatures, channels, ['Firefox'],
+                                         '>=2018-08-01', bids,
+                                         timings=timings, facets=facets)
+    assert get_numbers(res) == expected
+    assert ratios == expected_ratios
+    assert sorted(t[2] for t in timings) == ['20180803120000',
+                                             '20180804100000']
+
+
+def get_numbers(res):
+    return {p: {c: (n.signatures, n.raw.tolist(), n.installs.tolist())
+                for c, n in i.items()}
+            for p, i in res.items()}
+
+
+def get_buckets(sgn, buildids, size):
+    # sgn 'c' has crashes in all the builds, 'a' in the first two ones
+    # and 'b' has no crash
+    if sgn == 'b':
+        return []
+    if sgn == 'a':
+        buildids = buildids[:2]
+    buckets = []
+    for i, bid in enumerate(buildids[:size]):
+        count = i + 1
+        facets = {'install_time': [{'term': 0, 'count': count}],
+                  'cardinality_install_time': {'value': 1},
+                  'startup_crash': [{'term': 'T', 'count': count}],
+                  'platform_pretty_version': [{'term': 'Windows 10',
+                                               'count': count}]}
+        buckets.append({'term': bid,
+                        'count': count,
+                        'facets': facets})
+    return buckets
+
+
+class MyDataSuperSearch(MySuperSearch):
+
+    log = []
+
+    def wait(self):
+        for query in self.queries:
+            params = query.params
+            MyDataSuperSearch.log.append(params)
+            size = params['_facets_size']
+            if '_aggs.signature.build_id' in params:
+                sgns = []
+                for sgn in params['signature']:
+                    sgn = sgn[1:]
+                    buckets = get_buckets(sgn, params['build_id'], size)
+                    if buckets:
+                        sgns.append({'term': sgn,
+                                     'count': 1,
+                                     'facets': {'build_id': buckets}})
+                data = {'facets': {'signature': sgns}}
+            else:
+                sgn = params['signature'][1:]
+                buckets = get_buckets(sgn, params['build_id'], size)
+                data = {'facets': {'build_id': buckets}}
+            query.handler(self.parse(data), query.handlerdata)
+
+
+@patch('crashstop.streaming.SuperSearch', new=MyDataSuperSearch)
+def test_get_sgns_data_helper():
+    start = datetime(2018, 1, 1, 10, 0, 0, 0, pytz.utc)
+    dates = [start + relativedelta(days=i) for i in range(85)]
+    bids = {d: ('Firefox', 'nightly') for d in dates}
+    signatures = ['a', 'b', 'c']
+    numbers = CrashNumbers(signatures, dates, details=True)
+    data = {'Firefox': {'nightly': numbers}}
+    MyDataSuperSearch.log = []
+
+    dc.get_sgns_data_helper(data, signatures, bids, {}, '>=2018-01-01').wait()
+
+    # one batched query and one query for the signature with too many builds
+    assert len(MyDataSuperSearch.log) == 2
+    assert MyDataSuperSearch.log[1]['signature'] == '=c'
+
+    data = data['Firefox']['nightly']
+    assert data.seen.tolist() == [True, False, True]
+    a, c = data.index['a'], data.index['c']
+    assert data.raw[a, :3].tolist() == [1, 2, 0]
+    assert data.installs[a, :3].tolist() == [1, 1, 0]
+    assert data.startup[a, :3].tolist() == [100, 100, 0]
+    assert data.get_platforms(a) == {'Windows': 3}
+    assert data.raw[c, 79] == 80
+    assert data.platforms[c, 79].tolist() == [80, 0, 0, 0]
+
+
+def test_parse_facets():
+    data = {'facets': {'signature': [get_bucket('sgn-{}'.format(k), k, 3)
+                                     for k in range(1, 6)]}}
+    data['facets']['platform'] = [{'term': 'Windows', 'count': 1}]
+    res = streaming.parse_facets(io.BytesIO(json.dumps(data).encode('utf-8')),
+                                 'signature', ['facets.install_time'])
+
+    assert list(res.keys()) == ['facets']
+    assert list(res['facets'].keys()) == ['signature']
+    x = res['facets']['signature']
+    y = data['facets']['signature']
+    assert len(x) == len(y)
+    for a, b in zip(x, y):
+        assert a['term'] == b['term']
+        assert a['count'] == b['count']
+        a, b = a['facets'], b['facets']
+        assert isinstance(a['install_time'], streaming.Length)
+        assert len(a['install_time']) == len(b['install_time'])
+        assert (a['cardinality_install_time'] ==
+                b['cardinality_install_time'])
+
+
+class MyRevision:
+
+    log = []
+
+    def __init__(self, queries=None, **kwargs):
+        self.queries = queries
+
+    @staticmethod
+    def get_url(channel):
+        return channel
+
+    def wait(self):
+        for query in self.queries:
+            node = query.params['node']
+            MyRevision.log.append(node)
+            json = {'pushdate': [1533117600, 0],
+                    'backedoutby': 'xyz' if node == 'backedout' else ''}
+            query.handler(json, query.handlerdata)
+
+
+class MyHgRevision:
+
+    data = {}
+
+    @staticmethod
+    def get(keys):
+        data = MyHgRevision.data
+        return {k: data[k] for k in keys if k in data}
+
+    @staticmethod
+    def put_data(data, commit=True):
+        MyHgRevision.data.update(data)
+
+
+@patch('crashstop.datacollector.Revision', new=MyRevision)
+@patch('crashstop.models.HgRevision', new=MyHgRevision)
+def test_get_revisions():
+    pushdate = datetime(2018, 8, 1, 10, 0, 0, 0, pytz.utc)
+    MyHgRevision.data = {('beta', 'known'): (pushdate, False)}
+    MyRevision.log = []
+    chan_rev = {'nightly': ['abc', 'backedout'], 'beta': ['known']}
+
+    towait, revisions = dc.get_revisions(chan_rev)
+    for tw in towait:
+        tw.wait()
+
+    assert MyRevision.log == ['abc', 'backedout']
+    assert revisions == {('nightly', 'abc'): (pushdate, False),
+                         ('nightly', 'backedout'): (pushdate, True),
+                         ('beta', 'known'): (pushdate, False)}
+    assert MyHgRevision.data[('nightly', 'backedout')] == (pushdate, True)
+    pushdates = dc.get_channel_pushdates(chan_rev, revisions)
+    assert pushdates == {'nightly': [pushdate], 'beta': [pushdate]}
+
+    # all the revisions are in the db now
+    MyRevision.log = []
+    towait, revisions = dc.get_revisions(chan_rev)
+    assert towait == []
+    assert MyRevision.log == []
+    pushdates = dc.get_channel_pushdates(chan_rev, revisions)
+    assert pushdates == {'nightly': [pushdate], 'beta': [pushdate]}
+
+    # the esr channels are merged and the unknown revisions are ignored
+    chan_rev = {'esr52': ['known'], 'esr60': ['unknown']}
+    revisions = {('esr52', 'known'): (pushdate, False)}
+    pushdates = dc.get_channel_pushdates(chan_rev, revisions)
+    assert pushdates == {'esr': [pushdate]}
+
+
+class MySession:
+
+    def __init__(self):
+        self.hooks = []
+
+    def get(self, url, hooks=None, **kwargs):
+        self.hooks.append(hooks['response'])
+
+
+class MyResponse:
+
+    status_code = 200
+
+    def __init__(self, data):
+        self.content = json.dumps(data).encode('utf-8')
+        self.elapsed = timedelta(seconds=1)
+
+
+def test_streaming_hook():
+    # streaming.SuperSearch overrides a private method of libmozdata's
+    # Connection: check that it's still the one used for the callbacks
+    results = []
+    data = {'facets': {'signature': [get_bucket('sgn', 1, 2)]}}
+    query = Query(streaming.SuperSearch.URL, params={'signature': 'sgn'},
+                  handler=lambda json, res: res.append(json),
+                  handlerdata=results)
+    ss = streaming.SuperSearch(field='signature', queries=[],
+                               counted=['facets.install_time'])
+    ss.session = MySession()
+    ss.exec_queries([query])
+    assert len(ss.session.hooks) == 1
+
+    ss.session.hooks[0](MyResponse(data))
+    facets = results[0]['facets']['signature']
+    assert isinstance(facets[0]['facets']['install_time'], streaming.Length)
+    assert results[0]['elapsed'] >= 1
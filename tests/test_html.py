@@ -0,0 +1,57 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+from unittest.mock import patch
+
+
+class MySumups(object):
+
+    def __init__(self):
+        self.calls = []
+
+    def __call__(self, queries, extra):
+        self.calls.append(queries)
+        return [bugid for bugid, _, _ in queries]
+
+
+@patch('crashstop.config.get_sumups_max_bugs', new=lambda: 2)
+@patch('crashstop.html.render_sumup', new=lambda v, addon_version: str(v))
+def test_sumups(app):
+    client = app.test_client()
+    sumups = MySumups()
+    with patch('crashstop.cache.get_sumups', new=sumups):
+        bugs = [{'id': 123, 'h': ['nightly|abc'], 's': ['sgn']},
+                {'id': 456, 'h': [], 's': ['sgn2']}]
+        r = client.post('/sumups.json', data=json.dumps({'bugs': bugs}))
+        assert r.status_code == 200
+        assert json.loads(r.get_data(as_text=True)) == {'sumups': ['123',
+                                                                   '456']}
+
+        bugs.append({'id': 789, 'h': [], 's': ['sgn3']})
+        r = client.post('/sumups.json', data=json.dumps({'bugs': bugs}))
+        assert r.status_code == 400
+        assert 'error' in json.loads(r.get_data(as_text=True))
+
+    assert sumups.calls == [[(123, ['nightly|abc'], ['sgn']),
+                             (456, [], ['sgn2'])]]
+
+
+def test_sumups_malformed(app):
+    client = app.test_client()
+    sumups = MySumups()
+    bad = [[1],
+           'abc',
+           {'bugs': [1]},
+           {'bugs': 'abc'},
+           {'bugs': [{'id': 1, 's': 'abc'}]},
+           {'bugs': [{'id': 1, 'h': ['nightly|abc', 2]}]},
+           {'bugs': [], 'extra': 'abc'},
+           {'bugs': [], 'v': 1}]
+    with patch('crashstop.cache.get_sumups', new=sumups):
+        for query in bad:
+            r = client.post('/sumups.json', data=json.dumps(query))
+            assert r.status_code == 400
+            assert 'error' in json.loads(r.get_data(as_text=True))
+    assert sumups.calls == []
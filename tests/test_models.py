@@ -0,0 +1,224 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from crashstop import db, models
+from crashstop.crashnumbers import CrashNumbers
+from datetime import datetime
+import os
+import pytest
+import pytz
+from sqlalchemy import inspect
+from sqlalchemy.dialects import postgresql
+from unittest.mock import patch
+
+
+POSTGRES = os.environ.get('DATABASE_URL', '').startswith('postgres')
+BIDS = {'Firefox': {'nightly': [[datetime(2018, 8, d, 10, 0, 0, 0, pytz.utc),
+                                 '63.0a1', True, True] for d in range(1, 5)]}}
+
+
+def get_data(N=1000):
+    bids = [b[0] for b in BIDS['Firefox']['nightly']]
+    numbers = CrashNumbers(['sgn-{}'.format(n) for n in range(N)], bids)
+    patches = []
+    for n, sgn in enumerate(numbers):
+        numbers.raw[n] = numbers.installs[n] = n
+        patches.append((sgn, str(n % 100), bids[n % 4], bool(n % 2)))
+    return {'Firefox': {'nightly': {'numbers': numbers, 'patches': patches}}}
+
+
+@pytest.fixture()
+def database(app):
+    if not POSTGRES:
+        pytest.skip('needs a PostgreSQL database')
+    models.create()
+    models.Signatures.put_data(get_data(), BIDS, {'Firefox': {'nightly': 0.5}})
+    db.session.execute(db.text('ANALYZE signatures'))
+    yield None
+    models.clear()
+
+
+def explain(query):
+    compiled = query.statement.compile(dialect=postgresql.dialect())
+    cursor = db.session.connection().connection.cursor()
+    # the table is small, so make sure that a seq scan is not chosen
+    # for that reason
+    cursor.execute('SET enable_seqscan = off')
+    cursor.execute('EXPLAIN ' + str(compiled), compiled.params)
+    return '\n'.join(row[0] for row in cursor.fetchall())
+
+
+def test_bybugid_uses_index(database):
+    plan = explain(models.Signatures.query_bybugid(12))
+    assert 'signatures_bugid' in plan
+
+    res = models.Signatures.get_bybugid(12)
+    assert len(res['data']['Firefox']['nightly']) == 10
+    assert len(res['versions'][('Firefox', 'nightly')]) == 4
+
+
+def test_bypc_uses_index(database):
+    min_date = datetime(2018, 8, 1, 10, 0, 0, 0, pytz.utc)
+    max_date = datetime(2018, 8, 4, 10, 0, 0, 0, pytz.utc)
+    for filt in ['all', 'successful', 'unsuccessful']:
+        q = models.Signatures.query_bypc('Firefox', 'nightly', filt,
+                                         min_date, max_date)
+        assert 'signatures_pc_pushdate' in explain(q)
+
+
+def test_add_buildids(database):
+    d1 = datetime(2018, 8, 1, 10, 0, 0, 0, pytz.utc)
+    d5 = datetime(2018, 8, 5, 10, 0, 0, 0, pytz.utc)
+    bids = {'Firefox': {'nightly': [[d1, '63.0a2', False, True],
+                                    [d5, '63.0a1', True, True]]}}
+    models.Buildid.add_buildids(bids)
+
+    versions = models.Buildid.get_versions('Firefox', 'nightly', unicity=True)
+    assert versions['Firefox']['nightly'] == {d1: ('63.0a2', False, True),
+                                              d5: ('63.0a1', True, True)}
+
+    # a channel without buildids is emptied
+    models.Buildid.add_buildids({'Firefox': {'nightly': []}})
+    versions = models.Buildid.get_versions('Firefox', 'nightly')
+    assert versions['Firefox']['nightly'] == {}
+
+
+def test_hgrevision(database):
+    old = datetime(2018, 8, 1, 10, 0, 0, 0, pytz.utc)
+    young = pytz.utc.localize(datetime.utcnow())
+    models.HgRevision.put_data({('nightly', 'abc'): (old, False),
+                                ('nightly', 'def'): (young, True)})
+    keys = [('nightly', 'abc'), ('nightly', 'def'), ('beta', 'abc')]
+    assert models.HgRevision.get(keys) == {('nightly', 'abc'): (old, False),
+                                           ('nightly', 'def'): (young, True)}
+
+    # a young revision is only valid during revision_ttl seconds
+    with patch('crashstop.config.get_revision_ttl', new=lambda: -1):
+        expected = {('nightly', 'abc'): (old, False)}
+        assert models.HgRevision.get(keys) == expected
+
+
+def test_get_pushdates(database):
+    res = models.Signatures.get_pushdates()
+    assert len(res) == 1000
+    assert list(res['sgn-12'].keys()) == ['12']
+    assert list(res['sgn-12']['12'].keys()) == ['nightly']
+
+
+def test_patchinfo(database):
+    now = pytz.utc.localize(datetime.utcnow())
+    d1 = datetime(2018, 8, 1, 10, 0, 0, 0, pytz.utc)
+    models.PatchInfo.put_data({'123': (now, {'nightly': d1}),
+                               '456': (now, None),
+                               '789': (d1, {'beta': d1})})
+    # the bugs which haven't changed for a while are removed
+    assert models.PatchInfo.get() == {'123': (now, {'nightly': d1}),
+                                      '456': (now, None)}
+
+
+class MyResult(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchall(self):
+        return self.rows
+
+
+class MySession(object):
+    """Answer the upserts with the rows returned by RETURNING xmax = 0"""
+
+    def __init__(self, results):
+        self.results = results
+
+    def execute(self, query):
+        return MyResult(self.results.pop(0))
+
+    def commit(self):
+        pass
+
+
+def test_put_data_stats():
+    # 5 rows in 3 batches: the returned rows are the inserted (True) and
+    # updated (False) ones, the others are unchanged
+    session = MySession([[(True,), (False,)], [(True,)], []])
+    with patch.object(models.db, 'session', new=session), \
+         patch.object(models.Signatures, 'BATCH_SIZE', new=2), \
+         patch('crashstop.models.GlobalRatio.put_data'), \
+         patch('crashstop.models.Buildid.add_buildids'):
+        stats = models.Signatures.put_data(get_data(5), BIDS, {})
+    assert stats == {'inserted': 2, 'updated': 1, 'unchanged': 2}
+    assert session.results == []
+
+
+def test_put_data_stats_db(database):
+    ratios = {'Firefox': {'nightly': 0.5}}
+    data = get_data()
+    stats = models.Signatures.put_data(data, BIDS, ratios)
+    assert stats == {'inserted': 0, 'updated': 0, 'unchanged': 1000}
+
+    numbers = data['Firefox']['nightly']['numbers']
+    numbers.raw[3] += 1
+    numbers.raw[7] += 1
+    pushdate = BIDS['Firefox']['nightly'][0][0]
+    data['Firefox']['nightly']['patches'].append(('sgn-0', '999', pushdate,
+                                                  False))
+    stats = models.Signatures.put_data(data, BIDS, ratios)
+    assert stats == {'inserted': 1, 'updated': 2, 'unchanged': 998}
+
+
+def test_migrate_duplicates(database):
+    engine = db.engine
+    db.session.execute(db.text('DROP INDEX signatures_unicity'))
+    columns = ('product, channel, signature, bugid, '
+               'raw, installs, pushdate, success')
+    db.session.execute(db.text('INSERT INTO signatures ({0}) '
+                               'SELECT {0} FROM signatures '
+                               'WHERE bugid = 12'.format(columns)))
+    db.session.commit()
+    assert models.Signatures.query_bybugid(12).count() == 20
+
+    models.migrate(engine)
+    assert models.Signatures.query_bybugid(12).count() == 10
+    indexes = inspect(engine).get_indexes('signatures')
+    assert 'signatures_unicity' in {i['name'] for i in indexes}
+
+
+def test_sumup(database):
+    now = pytz.utc.localize(datetime.utcnow())
+    models.PatchInfo.put_data({'123': (now, None),
+                               '456': (now, None),
+                               '789': (now, None)})
+    # 1000 isn't a bug found by the updates
+    models.Sumup.add({123: ('key1', ['nightly|abc'], ['sgn']),
+                      456: ('key2', ['beta|def'], ['sgn2']),
+                      1000: ('key5', ['beta|def'], ['sgn2'])})
+    assert models.Sumup.get({123: 'key1'}) == {}
+    assert models.Sumup.get_inputs() == {
+        123: ('key1', ['nightly|abc'], ['sgn']),
+        456: ('key2', ['beta|def'], ['sgn2'])}
+
+    # one update by batch of bugs
+    with patch.object(models.Sumup, 'BATCH_SIZE', new=1):
+        models.Sumup.put_data({123: ('key1', 'value1'),
+                               456: ('key2', 'value2')}, now)
+    assert models.Sumup.get({123: 'key1', 456: 'key2', 789: 'key4'}) == {
+        123: 'value1', 456: 'value2'}
+    # other inputs
+    assert models.Sumup.get({123: 'key3'}) == {}
+
+    # the inputs changed: the value is removed until the next update
+    models.Sumup.add({456: ('key3', ['beta|ghi'], ['sgn2'])})
+    assert models.Sumup.get({456: 'key2'}) == {}
+    assert models.Sumup.get({456: 'key3'}) == {}
+    # the data computed for the old inputs aren't stored
+    models.Sumup.put_data({456: ('key2', 'value2')}, now)
+    assert models.Sumup.get({456: 'key3'}) == {}
+
+    # the table is full: the rows can be updated but no row is added
+    with patch('crashstop.config.get_sumup_max_rows', new=lambda: 2):
+        models.Sumup.add({123: ('key4', ['nightly|abc'], ['sgn3']),
+                          789: ('key6', ['nightly|abc'], ['sgn3'])})
+    assert set(models.Sumup.get_inputs().keys()) == {123, 456}
+    assert models.Sumup.get_inputs()[123][0] == 'key4'
@@ -0,0 +1,215 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from crashstop import patchinfo
+from datetime import datetime, timedelta
+from dateutil.parser import parse
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import json
+from libmozdata.bugzilla import Bugzilla
+import pytest
+import pytz
+import requests
+from six.moves.urllib.parse import parse_qs, urlparse
+from socketserver import ThreadingMixIn
+import threading
+import time
+from unittest.mock import patch
+
+
+D1 = datetime(2018, 8, 1, 10, 0, 0, 0, pytz.utc)
+D2 = datetime(2018, 8, 2, 10, 0, 0, 0, pytz.utc)
+BUGS = {'1': ('[@ a]', '2018-08-01T10:00:00Z'),
+        '2': ('[@ b]', '2018-08-02T10:00:00Z'),
+        '3': ('[@ a] [@ c]', '2018-08-02T10:00:00Z'),
+        '4': ('[@ d]', '2018-08-02T10:00:00Z')}
+LANDINGS = {'1': {'nightly': D1},
+            '2': {'beta': D2},
+            '3': {'nightly': D2}}
+
+
+class MyBugzilla(object):
+
+    # the search times out for the ranges longer than that
+    max_range = timedelta(days=365)
+    searches = []
+
+    def __init__(self, params, bughandler=None, bugdata=None, timeout=None):
+        assert 'last_change_time' in params['include_fields']
+        self.start = params['v3']
+        self.end = params['v4']
+        self.bughandler = bughandler
+        self.bugdata = bugdata
+
+    def get_data(self):
+        MyBugzilla.searches.append((self.start, self.end))
+        if self.end - self.start > MyBugzilla.max_range:
+            raise requests.exceptions.ReadTimeout()
+        for bugid, (sgns, last_change) in sorted(BUGS.items()):
+            date = datetime.strptime(last_change, '%Y-%m-%dT%H:%M:%SZ')
+            if not (self.start <= pytz.utc.localize(date) <= self.end):
+                continue
+            self.bughandler({'id': int(bugid),
+                             'cf_crash_signature': sgns,
+                             'last_change_time': last_change},
+                            self.bugdata)
+        return self
+
+    def wait(self):
+        pass
+
+
+analyzed = []
+
+
+def my_get_patch_info(bugs, channels=None):
+    analyzed.extend(bugs)
+    return {b: {'land': LANDINGS[b]} for b in bugs if b in LANDINGS}
+
+
+@patch('crashstop.patchinfo.ShardBugzilla', new=MyBugzilla)
+@patch('crashstop.patchinfo.get_patch_info', new=my_get_patch_info)
+@patch('crashstop.config.get_patchinfo_chunk_size', new=lambda: 1)
+def test_get_landings():
+    del analyzed[:]
+    # the bug 2 changed since its analysis
+    patchinfos = {'1': (D1, {'nightly': D1}),
+                  '2': (D1, None),
+                  '4': (D2, None)}
+    sgns, patches = patchinfo.get_landings(D1, D2 + timedelta(hours=1),
+                                           patchinfos=patchinfos)
+
+    assert sorted(analyzed) == ['2', '3']
+    assert sgns == {'a': ['1', '3'], 'b': ['2'], 'c': ['3'], 'd': ['4']}
+    assert patches == {b: {'land': land} for b, land in LANDINGS.items()}
+    assert patchinfos == {'1': (D1, {'nightly': D1}),
+                          '2': (D2, {'beta': D2}),
+                          '3': (D2, {'nightly': D2}),
+                          '4': (D2, None)}
+
+
+def test_get_shards():
+    end = D1 + timedelta(days=10, hours=1)
+    shards = patchinfo.get_shards(D1, end, 5)
+    assert shards == [(D1, D1 + timedelta(days=5)),
+                      (D1 + timedelta(days=5), D1 + timedelta(days=10)),
+                      (D1 + timedelta(days=10), end)]
+    assert patchinfo.get_shards(D1, D1, 5) == []
+
+
+@patch('crashstop.patchinfo.ShardBugzilla', new=MyBugzilla)
+@patch('crashstop.config.get_bugzilla_shard_days', new=lambda: 8)
+@patch.object(MyBugzilla, 'max_range', new=timedelta(days=3))
+def test_get_bugs_bisect():
+    del MyBugzilla.searches[:]
+    start = D1 - timedelta(days=15)
+    end = D2 + timedelta(days=1)
+    sgns, changes = patchinfo.get_bugs(start, end)
+
+    assert sgns == {'a': ['1', '3'], 'b': ['2'], 'c': ['3'], 'd': ['4']}
+    assert set(changes.keys()) == set(BUGS.keys())
+    assert changes['2'] == D2
+
+    # the two shards (8 and 9 days) have been bisected until 3 days
+    ok = sorted(s for s in MyBugzilla.searches
+                if s[1] - s[0] <= timedelta(days=3))
+    assert ok[0][0] == start
+    assert ok[-1][1] == end
+    for (s1, e1), (s2, e2) in zip(ok, ok[1:]):
+        assert e1 == s2
+
+
+@patch('crashstop.patchinfo.ShardBugzilla', new=MyBugzilla)
+@patch('crashstop.patchinfo.MIN_SHARD', new=timedelta(days=4))
+@patch.object(MyBugzilla, 'max_range', new=timedelta(days=3))
+def test_get_bugs_timeout():
+    with pytest.raises(requests.exceptions.Timeout):
+        patchinfo.get_bugs(D1 - timedelta(days=15), D2)
+
+
+class MyBugzillaServer(ThreadingMixIn, HTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self):
+        super(MyBugzillaServer, self).__init__(('127.0.0.1', 0),
+                                               MyBugzillaHandler)
+        self.searches = []
+
+
+class MyBugzillaHandler(BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        query = parse_qs(urlparse(self.path).query)
+        start, end = parse(query['v3'][0]), parse(query['v4'][0])
+        bugs = []
+        for bugid, (sgns, last_change) in sorted(BUGS.items()):
+            date = datetime.strptime(last_change, '%Y-%m-%dT%H:%M:%SZ')
+            if start <= pytz.utc.localize(date) <= end:
+                bugs.append({'id': int(bugid),
+                             'cf_crash_signature': sgns,
+                             'last_change_time': last_change})
+        if 'count_only' in query:
+            data = {'bug_count': len(bugs)}
+        else:
+            self.server.searches.append((start, end))
+            if end - start > MyBugzilla.max_range:
+                # longer than the timeout of the client
+                time.sleep(1)
+            offset = int(query['offset'][0])
+            data = {'bugs': bugs[offset:offset + int(query['limit'][0])]}
+        try:
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.end_headers()
+            self.wfile.write(json.dumps(data).encode('utf-8'))
+        except OSError:
+            # the client timed out
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def bugzilla_server():
+    server = MyBugzillaServer()
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+    with patch.object(Bugzilla, 'URL', new=url), \
+         patch.object(Bugzilla, 'API_URL', new=url + '/rest/bug'):
+        yield server
+    server.shutdown()
+    server.server_close()
+
+
+@patch('crashstop.patchinfo.TIMEOUT', new=0.2)
+@patch('crashstop.config.get_bugzilla_shard_days', new=lambda: 8)
+@patch.object(MyBugzilla, 'max_range', new=timedelta(days=3))
+def test_get_bugs_bisect_server(bugzilla_server):
+    start = D1 - timedelta(days=15)
+    end = D2 + timedelta(days=1)
+    sgns, changes = patchinfo.get_bugs(start, end)
+
+    assert sgns == {'a': ['1', '3'], 'b': ['2'], 'c': ['3'], 'd': ['4']}
+    assert set(changes.keys()) == set(BUGS.keys())
+    # the searches which timed out haven't been retried
+    searches = bugzilla_server.searches
+    assert len(searches) == len(set(searches))
+    assert any(e - s > timedelta(days=3) for s, e in searches)
+
+
+def test_is_timeout(bugzilla_server):
+    params = patchinfo.get_bz_params(D1 - timedelta(days=5), D2)
+    with patch.object(MyBugzilla, 'max_range', new=timedelta(days=3)):
+        bz = patchinfo.ShardBugzilla(params,
+                                     bughandler=lambda bug, data: None,
+                                     bugdata={},
+                                     timeout=0.2)
+        with pytest.raises(requests.exceptions.ConnectionError) as e:
+            bz.get_data().wait()
+    assert patchinfo.is_timeout(e.value)
+    assert not patchinfo.is_timeout(requests.exceptions.ConnectionError())
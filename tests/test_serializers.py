@@ -0,0 +1,117 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from collections import OrderedDict
+from crashstop import serializers, utils
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+import numpy as np
+import pickle
+import pytest
+import pytz
+import time
+import zlib
+
+
+def get_sumup(S, B, seed=42):
+    """Generate a value for sumup.html with S signatures and B buildids
+       in each product/channel"""
+    rand = np.random.RandomState(seed)
+    start = datetime(2018, 8, 1, 10, 0, 0, 0, pytz.utc)
+    dates = [start + relativedelta(days=i) for i in range(B)]
+    bids = [utils.get_buildid(d) for d in dates]
+    data = OrderedDict()
+    versions = {}
+    for prod in utils.get_products():
+        data[prod] = d = OrderedDict()
+        for chan in utils.get_channels():
+            versions[(prod, chan)] = {b: '63.0a{}'.format(i % 3)
+                                      for i, b in enumerate(bids)}
+            infos = []
+            for s in range(S):
+                sgn = 'mozilla::dom::Something<T>::Method{}'.format(s)
+                url = 'https://crash-stats.mozilla.com/search/?s=' + sgn
+                raw = rand.randint(0, 100, B).tolist()
+                info = {'pushdate': dates[rand.randint(0, B)],
+                        'raw': raw,
+                        'installs': [x // 2 for x in raw],
+                        'startup': rand.randint(-1, 100, B).tolist(),
+                        'platforms': {'Windows': 80.5, 'Linux': 19.5},
+                        'socorro_url': url,
+                        'base_url': url,
+                        'position': int(rand.randint(-2, B)),
+                        'buildids': bids}
+                infos.append((sgn, info))
+            d[chan] = infos
+    affected = {chan: 63 for chan in utils.get_channels()}
+
+    return (time.time() + 600, (data, versions, affected, False))
+
+
+def normalize(x):
+    """Lists and tuples are the same for the templates"""
+    if isinstance(x, (list, tuple)):
+        return [normalize(y) for y in x]
+    if isinstance(x, dict):
+        return {k: normalize(v) for k, v in x.items()}
+    return x
+
+
+def test_roundtrip():
+    entry = get_sumup(3, 5)
+    for name in serializers.SERIALIZERS.keys():
+        for level in [0, 1, 9]:
+            ser = serializers.get_serializer(name, compress_level=level)
+            res = ser.loads(ser.dumps(entry))
+            assert normalize(res) == normalize(entry)
+            data = res[1][0]
+            assert list(data.keys()) == list(entry[1][0].keys())
+            info = data['Firefox']['nightly'][0][1]
+            expected = entry[1][0]['Firefox']['nightly'][0][1]
+            assert info['pushdate'] == expected['pushdate']
+            assert info['pushdate'].tzinfo is pytz.utc
+            pc = ('Firefox', 'nightly')
+            assert res[1][1][pc] == entry[1][1][pc]
+
+
+def test_schema_version():
+    entry = get_sumup(1, 2)
+    old = serializers.get_serializer('pickle').dumps(entry)
+    assert serializers.get_serializer('msgpack').loads(old) is None
+    # a value put by bmemcached itself
+    assert serializers.get_serializer('msgpack').loads(entry) is None
+    assert serializers.get_serializer('msgpack').loads(None) is None
+
+
+@pytest.mark.benchmark
+def test_benchmark_serializers():
+    entry = get_sumup(20, 50)
+    N = 20
+
+    def pickle_zlib9_dumps(value):
+        return zlib.compress(pickle.dumps(value, pickle.HIGHEST_PROTOCOL), 9)
+
+    def pickle_zlib9_loads(data):
+        return pickle.loads(zlib.decompress(data))
+
+    candidates = [('pickle+zlib9', pickle_zlib9_dumps, pickle_zlib9_loads)]
+    for name in ['pickle', 'msgpack']:
+        for level in [1, 6]:
+            ser = serializers.get_serializer(name, compress_level=level)
+            candidates.append(('{}+zlib{}'.format(name, level),
+                               ser.dumps, ser.loads))
+
+    for name, dumps, loads in candidates:
+        start = time.time()
+        for _ in range(N):
+            data = dumps(entry)
+        encode = (time.time() - start) / N
+
+        start = time.time()
+        for _ in range(N):
+            loads(data)
+        decode = (time.time() - start) / N
+
+        print('{}: {} bytes, encode {:.2f}ms, decode {:.2f}ms'
+              .format(name, len(data), encode * 1000., decode * 1000.))
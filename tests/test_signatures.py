@@ -0,0 +1,148 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from crashstop import signatures, utils
+from crashstop.crashnumbers import CrashNumbers
+from datetime import datetime
+import pytz
+from unittest.mock import patch
+
+
+def test_update_patches():
+    d1 = datetime(2018, 8, 1, 10, 0, 0, 0, pytz.utc)
+    d2 = datetime(2018, 8, 2, 10, 0, 0, 0, pytz.utc)
+    d3 = datetime(2018, 8, 3, 10, 0, 0, 0, pytz.utc)
+    patches = {'a': {'123': {'nightly': d3}},
+               'b': {'456': {'beta': d2}}}
+    old_a = {'123': {'nightly': d1, 'beta': d1},
+             '789': {'nightly': d2}}
+    old_c = {'123': {'nightly': d1}}
+    old_patches = {'a': old_a, 'c': old_c}
+
+    res = signatures.update_patches(patches, old_patches)
+
+    assert res is patches
+    assert res == {'a': {'123': {'nightly': d3, 'beta': d1},
+                         '789': {'nightly': d2}},
+                   'b': {'456': {'beta': d2}},
+                   'c': {'123': {'nightly': d1}}}
+    # the old dicts are reused
+    assert res['c'] is old_c
+    assert res['a']['789'] is old_a['789']
+
+
+def test_get_for_chan_rev_sgns():
+    d1 = datetime(2018, 8, 1, 10, 0, 0, 0, pytz.utc)
+    d2 = datetime(2018, 8, 2, 10, 0, 0, 0, pytz.utc)
+    calls = {'revisions': [], 'sgns': []}
+
+    def get_revisions(chan_rev):
+        calls['revisions'].append({c: sorted(r) for c, r in chan_rev.items()})
+        return [], {('nightly', 'abc'): (d1, False),
+                    ('nightly', 'def'): (d2, False),
+                    ('beta', 'xyz'): (d2, True)}
+
+    def get_sgns_data(channels, all_versions, sgns, extra, products, towait,
+                      date='today'):
+        calls['sgns'].append(sorted(sgns))
+        numbers = CrashNumbers(sorted(sgns), [d1, d2], details=True)
+        numbers.raw[:] = 1
+        numbers.seen[:] = True
+        return {'Firefox': {'nightly': numbers}}
+
+    versions = {d1: ('63.0a1', True, True), d2: ('63.0a1', True, True)}
+    all_versions = {'Firefox': {c: versions for c in utils.get_channels()}}
+
+    def get_all_versions(products, channels):
+        return all_versions
+
+    queries = [({'nightly': ['abc']}, ['a', 'b']),
+               ({'nightly': ['abc', 'def'], 'beta': ['xyz']}, ['b', 'c']),
+               ({}, [])]
+    with patch('crashstop.datacollector.get_revisions', new=get_revisions), \
+         patch('crashstop.datacollector.get_sgns_data', new=get_sgns_data), \
+         patch('crashstop.signatures.get_all_versions', new=get_all_versions):
+        res = signatures.get_for_chan_rev_sgns(queries, ['Firefox'])
+
+    # hg and Socorro are queried once
+    assert calls['revisions'] == [{'nightly': ['abc', 'def'], 'beta': ['xyz']}]
+    assert calls['sgns'] == [['a', 'b', 'c']]
+
+    assert len(res) == 3
+    data = res[0]['data']['Firefox']['nightly']
+    assert sorted(data.keys()) == ['a', 'b']
+    assert data['a']['pushdate'] == d1
+    data = res[1]['data']['Firefox']['nightly']
+    assert sorted(data.keys()) == ['b', 'c']
+    assert data['b']['pushdate'] == d2
+    versions = res[1]['versions'][('Firefox', 'nightly')]
+    assert versions == {d1: '63.0a1', d2: '63.0a1'}
+    assert res[2] == {'data': {}, 'versions': {}}
+
+
+def test_get_sumups():
+    inputs = {123: ('key1', ['nightly|abc'], ['a', 'b']),
+              456: ('key2', ['beta|def'], ['c'])}
+    calls = []
+
+    def get_for_sumups(queries, date='today'):
+        calls.append(queries)
+        return [{'data': q, 'versions': {}} for q in queries]
+
+    def prepare_bug_for_html(data):
+        return data['data']
+
+    with patch('crashstop.signatures.get_for_sumups', new=get_for_sumups), \
+         patch('crashstop.signatures.prepare_bug_for_html',
+               new=prepare_bug_for_html):
+        res = signatures.get_sumups(inputs)
+
+    # all the bugs are computed at once from the inputs sent by the addon
+    assert len(calls) == 1
+    assert res == {123: ('key1', (['nightly|abc'], ['a', 'b'])),
+                   456: ('key2', (['beta|def'], ['c']))}
+
+
+def test_update_sumups_failure(app):
+    d1 = datetime(2018, 8, 1, 10, 0, 0, 0, pytz.utc)
+    calls = []
+
+    def get(date='today', facets=None, patchinfos=None):
+        return {}, {}, {}, {}, d1
+
+    def get_sumups(inputs, date='today'):
+        calls.append('sumups')
+        raise Exception('hg is down')
+
+    def record(name):
+        return lambda *args, **kwargs: calls.append(name)
+
+    with patch('crashstop.signatures.get', new=get), \
+         patch('crashstop.signatures.get_sumups', new=get_sumups), \
+         patch('crashstop.signatures.warm_cache', new=record('warm')), \
+         patch('crashstop.models.PatchInfo.get', new=lambda: {}), \
+         patch('crashstop.models.PatchInfo.put_data', new=record('pi')), \
+         patch('crashstop.models.Signatures.put_data', new=record('sgns')), \
+         patch('crashstop.models.Signatures.clean', new=record('clean')), \
+         patch('crashstop.models.Sumup.get_inputs', new=lambda: {}), \
+         patch('crashstop.models.Lastdate.set', new=record('lastdate')), \
+         app.app_context():
+        signatures.update(incremental=False)
+
+    # the last date is set and the cache warmed before the sumup data
+    # which can fail without failing the update
+    assert calls == ['sgns', 'pi', 'clean', 'lastdate', 'warm', 'sumups']
+
+
+def test_log_timings():
+    timings = [('Firefox', 'nightly', '20180801100000', 0.5),
+               ('Firefox', 'beta', '20180801100000', 2.),
+               ('Firefox', 'nightly', '20180802100000', 1.5)]
+    with patch('crashstop.signatures.logger') as logger:
+        signatures.log_timings('ratios', timings)
+        signatures.log_timings('numbers', [])
+    logger.info.assert_called_once_with(
+        'Time spent in the ratios queries: '
+        'Firefox-beta: 1 queries in 2.0s (max 2.0s), '
+        'Firefox-nightly: 2 queries in 2.0s (max 1.5s).')
@@ -0,0 +1,138 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from crashstop import tools
+from crashstop.crashnumbers import CrashNumbers
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+import numpy as np
+import pytest
+import pytz
+import time
+
+
+def get_channel(N, B, seed=42):
+    """Generate a channel with N signatures and B buildids"""
+    rand = np.random.RandomState(seed)
+    start = datetime(2018, 8, 1, 10, 0, 0, 0, pytz.utc)
+    bids = [[start + relativedelta(days=i), '63.0a1', True, True]
+            for i in range(B)]
+    data = CrashNumbers(['sgn-{}'.format(n) for n in range(N)],
+                        [b[0] for b in bids])
+    patches = {}
+    for n in range(N):
+        sgn = 'sgn-{}'.format(n)
+        kind = n % 4
+        if kind == 0:
+            installs = rand.randint(0, 5, B)
+        elif kind == 1:
+            installs = rand.randint(0, 50, B)
+        elif kind == 2:
+            # a spike somewhere
+            installs = rand.randint(0, 10, B)
+            installs[rand.randint(0, B):] += rand.randint(10, 100)
+        else:
+            installs = np.zeros(B, dtype=np.int64)
+            installs[rand.randint(0, B)] = rand.randint(1, 20)
+        data.raw[n] = 2 * installs
+        data.installs[n] = installs
+
+        patches[sgn] = patch = {}
+        for bug in range(1 + n % 3):
+            # pushdates before, between and after the buildids
+            delta = relativedelta(days=int(rand.randint(-1, B + 2)),
+                                  hours=int(rand.randint(-12, 12)))
+            patch[str(1000 + bug)] = {'nightly': start + delta}
+
+    ratios = {'Firefox': {'nightly': tools.get_global_ratios(data)}}
+    data = {'Firefox': {'nightly': data}}
+    bids = {'Firefox': {'nightly': bids}}
+
+    return data, patches, bids, ratios
+
+
+def compute_success_slow(data, patches, bids, ratios):
+    """The row by row version of compute_success"""
+    res = {}
+    for prod, i in data.items():
+        res[prod] = res_prod = {}
+        for chan, j in i.items():
+            ratio = ratios[prod][chan]
+            bids_chan = [b[0] for b in bids[prod][chan]]
+            min_value = tools.config.get_min(prod, chan)
+            res_chan = []
+            for sgn in j:
+                installs = j.get_raw_installs(sgn)[1]
+                for bug, k in patches[sgn].items():
+                    pushdate = k.get(chan)
+                    if not pushdate or bids_chan[0] > pushdate:
+                        continue
+                    success = tools.check_patch(installs, pushdate, bids_chan,
+                                                ratio, min_value)
+                    res_chan.append((sgn, bug, pushdate, success))
+            if res_chan:
+                res_prod[chan] = {'numbers': j, 'patches': res_chan}
+    return res
+
+
+def test_check_patches():
+    bids = [datetime(2018, 8, d, 10, 0, 0, 0, pytz.utc) for d in range(1, 9)]
+    installs = [[3, 4, 3, 40, 45, 0, 0, 1],
+                [3, 4, 3, 40, 45, 30, 50, 41],
+                [0, 0, 0, 0, 0, 0, 0, 0],
+                [1, 1, 1, 1, 1, 1, 1, 1],
+                [10, 0, 12, 9, 11, 2, 1, 0],
+                [0, 0, 7, 0, 0, 0, 0, 0]]
+    for ratio in [0., 0.5, 1.3, float('nan')]:
+        for min_value in [1, 3, 50]:
+            for pos in range(len(bids) + 1):
+                positions = [pos] * len(installs)
+                res = tools.check_patches(installs, positions, ratio,
+                                          min_value)
+                for x, r in zip(installs, res.tolist()):
+                    if pos == len(bids):
+                        pushdate = bids[-1] + relativedelta(days=1)
+                    else:
+                        pushdate = bids[pos]
+                    assert r == tools.check_patch(x, pushdate, bids,
+                                                  ratio, min_value)
+
+
+def test_compute_success():
+    for B in [1, 2, 5, 14]:
+        data, patches, bids, ratios = get_channel(1000, B, seed=B)
+        x = tools.compute_success(data, patches, bids, ratios)
+        y = compute_success_slow(data, patches, bids, ratios)
+        assert x == y
+
+
+def test_compute_success_unknown_signature():
+    data, patches, bids, ratios = get_channel(100, 5)
+    expected = tools.compute_success(data, patches, bids, ratios)
+    # a signature in the crash numbers without any patch
+    del patches['sgn-0']
+    res = tools.compute_success(data, patches, bids, ratios)
+    patches = expected['Firefox']['nightly']['patches']
+    expected['Firefox']['nightly']['patches'] = [p for p in patches
+                                                 if p[0] != 'sgn-0']
+    assert res == expected
+
+
+@pytest.mark.benchmark
+def test_benchmark_compute_success():
+    for N, B in [(10000, 14), (20000, 10)]:
+        data, patches, bids, ratios = get_channel(N, B)
+
+        start = time.time()
+        y = compute_success_slow(data, patches, bids, ratios)
+        slow = time.time() - start
+
+        start = time.time()
+        x = tools.compute_success(data, patches, bids, ratios)
+        fast = time.time() - start
+
+        assert x == y
+        print('compute_success for {} signatures and {} buildids: '
+              'row by row {:.3f}s, vectorized {:.3f}s'
+              .format(N, B, slow, fast))
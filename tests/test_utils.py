@@ -0,0 +1,117 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from crashstop import utils
+from datetime import datetime
+from dateutil.relativedelta import relativedelta
+from libmozdata import socorro
+import pytest
+import pytz
+import requests
+from six.moves.urllib.parse import parse_qs, urlparse
+import time
+
+
+def get_build_date_slow(bid):
+    """The previous implementation of get_build_date"""
+    bid = str(bid)
+    d = datetime(int(bid[0:4]), int(bid[4:6]), int(bid[6:8]),
+                 int(bid[8:10]), int(bid[10:12]), int(bid[12:]))
+    return pytz.utc.localize(d)
+
+
+def get_buildid_slow(date):
+    return date.strftime('%Y%m%d%H%M%S')
+
+
+def get_dates(N):
+    start = datetime(2018, 1, 9, 3, 7, 5, 0, pytz.utc)
+    return [start + relativedelta(days=i, hours=i, minutes=i, seconds=i)
+            for i in range(N)]
+
+
+def test_buildid_codec():
+    for date in get_dates(400):
+        bid = get_buildid_slow(date)
+        assert utils.get_buildid(date) == bid
+        assert utils.get_buildid_as_int(date) == int(bid)
+        assert utils.get_build_date(bid) == date
+        assert utils.get_build_date(int(bid)) == date
+        assert utils.get_build_date(bid).tzinfo is pytz.utc
+
+    # the same instant in another timezone (first or second in the cache)
+    for hour in [1, 2]:
+        date = datetime(2017, 1, 9, hour, 7, 5, 0, pytz.utc)
+        paris = date.astimezone(pytz.timezone('Europe/Paris'))
+        bid = get_buildid_slow(date)
+        if hour == 1:
+            assert utils.get_buildid(paris) == bid
+            assert utils.get_buildid(date) == bid
+        else:
+            assert utils.get_buildid(date) == bid
+            assert utils.get_buildid(paris) == bid
+        assert utils.get_buildid_as_int(paris) == int(bid)
+
+    # the datetimes are interned
+    date = utils.get_build_date('20180109030705')
+    assert date is utils.get_build_date(20180109030705)
+
+
+@pytest.mark.benchmark
+def test_benchmark_buildid_codec():
+    # as in prepare_signatures_for_html: a link per signature and buildid
+    dates = get_dates(50)
+    bids = [get_buildid_slow(d) for d in dates]
+    N = 2000
+
+    start = time.time()
+    for _ in range(N):
+        for d, b in zip(dates, bids):
+            get_buildid_slow(d)
+            get_build_date_slow(b)
+    slow = time.time() - start
+
+    start = time.time()
+    for _ in range(N):
+        for d, b in zip(dates, bids):
+            utils.get_buildid(d)
+            utils.get_build_date(b)
+    fast = time.time() - start
+
+    print('buildid codec for {} signatures and {} buildids: '
+          'uncached {:.3f}s, cached {:.3f}s'.format(N, len(dates), slow, fast))
+
+
+def test_get_crash_reports_link():
+    query = {'product': 'Firefox',
+             'release_channel': ['beta', 'aurora'],
+             'signature': '=foo::bar<T>'}
+    params = utils.get_params_for_link(query=query)
+    base = socorro.SuperSearch.get_link(params)
+    params.update({'build_id': '=20180801100000', 'version': '62.0b1'})
+    expected = urlparse(socorro.SuperSearch.get_link(params))
+
+    link = utils.get_crash_reports_link(base, '20180801100000', '62.0b1')
+    link = urlparse(link)
+    assert link.fragment == 'crash-reports'
+    assert link.path == expected.path
+    assert parse_qs(link.query) == parse_qs(expected.query)
+
+
+def test_chunk_signatures():
+    signatures = ['sgn-{}'.format(i) for i in range(10)]
+    signatures += ['foo::bar<T> | {}'.format(i) * (i + 1) for i in range(20)]
+    signatures.append('x' * 300)
+    batches = list(utils.chunk_signatures(signatures, 8, 200))
+    assert [s for b in batches for s in b] == signatures
+    assert batches[-1] == ['x' * 300]
+    for batch in batches:
+        assert len(batch) <= 8
+        if len(batch) == 1:
+            # too long to be batched
+            continue
+        params = {'signature': ['=' + s for s in batch]}
+        url = requests.Request('GET', 'https://foo.bar/',
+                               params=params).prepare().url
+        assert len(urlparse(url).query) <= 200
@@ -213,16 +213,18 @@ if (container) {
     const spart = signatures.join("&") + "&";
     const extra = extraSocorroArgs.join("&");
     const vpart = "v=" + VERSION + "&";
-    const crashStopLink = sumup + "?" + vpart + hpart + spart + extra;
-    const LSName = "Crash-Stop-V1";
-    const iframe = document.createElement("iframe");
-    let statusFlagsSelects = null;
     let bugid;
     if (oldWay) {
       bugid = document.getElementById("shorturl").getAttribute("href").slice("https://bugzil.la/".length);
     } else {
       bugid = document.getElementById("this-bug").innerText.split(" ")[1];
     }
+    // the data for the bug are precomputed on the server
+    const idpart = "id=" + bugid + "&";
+    const crashStopLink = sumup + "?" + vpart + idpart + hpart + spart + extra;
+    const LSName = "Crash-Stop-V1";
+    const iframe = document.createElement("iframe");
+    let statusFlagsSelects = null;
     window.addEventListener("message", function (e) {
       if (e.origin == crashStop) {
         const iframe = document.getElementById("crash-stop-iframe");